@@ -1,26 +1,55 @@
+import atexit
+import codecs
+import collections
+import itertools
 import os
 import subprocess
 import json
-import yaml
-import platform
 import re
 import shutil
 import asyncio
+import functools
 import argparse
+import logging
+from importlib.metadata import distributions
+from concurrent.futures import ThreadPoolExecutor
 import shlex
+import sqlite3
+import stat
+import sys
+import threading
+import time
+from typing import Iterator
 
 from planner import (
     PlanStep,
-    generate_plan,
+    iter_plan,
+    forget_plan,
     save_plan,
     load_plan as load_task_plan,
     execute_plan,
     interactive_edit_plan,
 )
 
-import openai
-from dotenv import load_dotenv
-from pydantic import BaseModel, ValidationError
+try:  # optional: match rule lists in a single pass
+    import ahocorasick
+except ImportError:  # pragma: no cover - depends on environment
+    ahocorasick = None
+
+try:  # optional: exact token counts for the history budget
+    import tiktoken
+except ImportError:  # pragma: no cover - depends on environment
+    tiktoken = None
+
+try:  # optional: faster knowledge file (de)serialization
+    import orjson
+except ImportError:  # pragma: no cover - depends on environment
+    orjson = None
+
+try:  # optional: faster event loop for concurrent plan steps and --script
+    import uvloop
+except ImportError:  # pragma: no cover - depends on environment
+    uvloop = None
 
 DANGEROUS_PATTERNS = [
     "rm -rf /",
@@ -54,13 +83,86 @@ DEFAULT_AUTO_COMMANDS = [
 # Path to optional whitelist file similar to .gitignore
 DEFAULT_WHITELIST_PATH = ".cortanaignore"
 
+# Token budget for the conversation resent with each request, excluding the
+# system prompt. Older turns are dropped once it is exceeded.
+MAX_HISTORY_TOKENS = 3000
+
+# Failed commands are reported here as well as printed, for callers that log
+logger = logging.getLogger("cortana")
+logger.addHandler(logging.NullHandler())
+
+# Chat model and response format used for every suggestion request; JSON mode
+# makes the API return a single JSON object, as the system prompt asks for
+CHAT_MODEL = "gpt-3.5-turbo"
+RESPONSE_FORMAT = {"type": "json_object"}
+
+# Maximum number of requests in flight when answering a --script file
+SCRIPT_CONCURRENCY = 10
+
+# Directory for caches that can be safely deleted at any time
+DEFAULT_CACHE_DIR = "~/.cache/cortana"
+
+# Seconds before stored system details are gathered again (CORTANA_SYSTEM_TTL)
+DEFAULT_SYSTEM_TTL = 3600
+
+# dpkg's package database, read directly instead of running dpkg-query
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+
+# Process table read by list_running_services instead of running ps
+PROC_PATH = "/proc"
+
+# Package databases that can be queried directly instead of running rpm -qa.
+# Each entry is (path, query returning one package per row).
+RPM_SQLITE_SOURCES = [
+    ("/var/cache/dnf/packages.db", "SELECT pkg FROM installed"),
+    ("/var/lib/rpm/rpmdb.sqlite", "SELECT key FROM Name"),
+]
+
+# Largest read from a command's output pipe; matches Linux's default pipe size
+READ_CHUNK_SIZE = 65536
+
+# Commands containing any of these need a real shell, so skip the builtins
+SHELL_META_RE = re.compile(r"[|&;<>()$`\\\"'*?\[\]{}~!#\n]")
+
 # Maintain a persistent current working directory across commands
 CURRENT_DIR = os.getcwd()
 
+# Knowledge bases with command log entries not yet folded into their snapshot
+_PENDING_SNAPSHOTS: dict[str, dict] = {}
+
+# Knowledge file writes run on one background thread, in submission order, so
+# the next API request can go out while the last result is persisted
+_KNOWLEDGE_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="knowledge")
+_last_knowledge_write = None
 
-class CortanaResponse(BaseModel):
-    explanation: str
-    command: str
+# Held while the knowledge writer thread updates or serializes a knowledge base
+_KNOWLEDGE_LOCK = threading.Lock()
+
+# Logged commands after which update_knowledge folds the log into a snapshot
+KNOWLEDGE_SNAPSHOT_EVERY = 50
+_logged_commands: dict[str, int] = {}
+
+# Rules built by load_rules(), keyed on the signatures of the rule files
+_rules_cache: dict[tuple, dict] = {}
+
+
+@functools.lru_cache(maxsize=1)
+def cortana_response_model():
+    """Build the reply model on first use, since importing pydantic is slow."""
+    from pydantic import BaseModel
+
+    class CortanaResponse(BaseModel):
+        explanation: str
+        command: str
+
+    return CortanaResponse
+
+
+def __getattr__(name: str):
+    # Keep `cortana.CortanaResponse` available without importing pydantic eagerly
+    if name == "CortanaResponse":
+        return cortana_response_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def escape_inner_quotes(text: str) -> str:
@@ -76,162 +178,575 @@ def escape_inner_quotes(text: str) -> str:
     return ''.join(result)
 
 
+JSON_FIELD_RE = re.compile(
+    r'("(?:explanation|command)"\s*:\s*")(.*?)(?<!\\)"(?=\s*(?:,|}))', re.DOTALL
+)
+
+
 def sanitize_json_quotes(raw: str) -> str:
     """Escape problematic quotes in explanation or command fields."""
-    pattern = r'("(?:explanation|command)"\s*:\s*")(.*?)(?<!\\)"(?=\s*(?:,|}))'
-    return re.sub(
-        pattern,
+    return JSON_FIELD_RE.sub(
         lambda m: m.group(1) + escape_inner_quotes(m.group(2)) + '"',
         raw,
-        flags=re.DOTALL,
     )
 
 
-def parse_cortana_response(raw: str) -> CortanaResponse | None:
+EXPLANATION_START_RE = re.compile(r'"explanation"\s*:\s*"')
+
+
+def _delta_text(chunk) -> str:
+    """Return the text carried by a streamed completion chunk."""
+    if not chunk.choices:
+        return ""
+    delta = chunk.choices[0].delta
+    content = delta.get("content") if isinstance(delta, dict) else delta.content
+    return content or ""
+
+
+def stream_explanation(chunks) -> tuple[str, str]:
+    """Echo the explanation field while a reply streams in.
+
+    Returns the full raw reply and the explanation text already printed.
+    """
+    raw = ""
+    shown: list[str] = []
+    pos = None
+    done = False
+    for chunk in chunks:
+        raw += _delta_text(chunk)
+        if done:
+            continue
+        if pos is None:
+            match = EXPLANATION_START_RE.search(raw)
+            if not match:
+                continue
+            pos = match.end()
+        pieces = []
+        while pos < len(raw):
+            ch = raw[pos]
+            if ch == "\\":
+                width = 6 if raw[pos + 1 : pos + 2] == "u" else 2
+                if width == 6 and "d800" <= raw[pos + 2 : pos + 6].lower() <= "dbff":
+                    # A high surrogate is decoded together with the low one after it
+                    if pos + 8 > len(raw):
+                        break
+                    if raw[pos + 6 : pos + 8] == "\\u":
+                        width = 12
+                if pos + width > len(raw):
+                    break
+                try:
+                    text = json.loads(f'"{raw[pos:pos + width]}"')
+                except ValueError:
+                    text = raw[pos + 1 : pos + width]
+                if "\ud800" <= text[-1:] <= "\udfff":
+                    text = text[:-1] + "\ufffd"  # unpaired surrogate can't be written
+                pieces.append(text)
+                pos += width
+            elif ch == '"':
+                done = True
+                break
+            else:
+                pieces.append(ch)
+                pos += 1
+        if pieces:
+            if not shown:
+                sys.stdout.write("AI: ")
+            shown.extend(pieces)
+            sys.stdout.write("".join(pieces))
+            sys.stdout.flush()
+    return raw, "".join(shown)
+
+
+def _load_cortana_response(raw: str) -> "CortanaResponse | None":
+    # Two string fields don't need full model validation; check them directly
+    try:
+        data = _json_loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    explanation = data.get("explanation")
+    command = data.get("command")
+    if not isinstance(explanation, str) or not isinstance(command, str):
+        return None
+    return cortana_response_model().model_construct(
+        explanation=explanation, command=command
+    )
+
+
+def parse_cortana_response(raw: str) -> "CortanaResponse | None":
     """Parse Cortana JSON, attempting to fix unescaped quotes."""
+    return _load_cortana_response(raw) or _load_cortana_response(
+        sanitize_json_quotes(raw)
+    )
+
+
+def read_dpkg_status() -> list[str] | None:
+    """Read installed package names from dpkg's status file."""
+    packages = []
+    name = None
     try:
-        return CortanaResponse.model_validate_json(raw)
-    except ValidationError:
-        fixed = sanitize_json_quotes(raw)
+        with open(DPKG_STATUS_PATH, "rb") as f:
+            for line in f:
+                if line.startswith(b"Package: "):
+                    name = line[9:].strip()
+                elif name is not None and line.startswith(b"Status: "):
+                    if line.rstrip().endswith(b" installed"):
+                        packages.append(name.decode())
+                    name = None
+    except OSError:
+        return None
+    return packages
+
+
+def read_rpm_sqlite() -> list[str] | None:
+    """Read installed rpm packages straight from a SQLite package database."""
+    for path, query in RPM_SQLITE_SOURCES:
+        if not os.path.exists(path):
+            continue
         try:
-            return CortanaResponse.model_validate_json(fixed)
-        except ValidationError:
-            return None
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                rows = conn.execute(query).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            continue
+        return [row[0] for row in rows]
+    return None
 
 
-def gather_system_info() -> dict:
-    """Collect basic system details."""
-    info = {
-        "os": platform.platform(),
-        "python_version": platform.python_version(),
-        "disk_free_mb": 0,
-        "memory_total_mb": 0,
-        "packages": [],
-        "running_services": [],
-    }
+def command_lines(args: list[str], skip: int = 0) -> list[str]:
+    """Run a command and collect its output lines as they are produced."""
+    with subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    ) as proc:
+        for _ in range(skip):
+            next(proc.stdout, None)
+        lines = [line.rstrip("\n") for line in proc.stdout if line.strip()]
+    return lines if proc.returncode == 0 else []
+
+
+def package_db_mtime() -> float | None:
+    """Return the modification time of the package database in use, if any."""
+    for path in [DPKG_STATUS_PATH] + [p for p, _ in RPM_SQLITE_SOURCES]:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            continue
+    return None
+
+
+def list_packages() -> list[str]:
+    """List installed packages from the dpkg/rpm databases, their command
+    line tools, or the Python environment."""
+    if (dpkg_packages := read_dpkg_status()) is not None:
+        return dpkg_packages
+    if shutil.which("dpkg-query"):
+        return command_lines(["dpkg-query", "-f", "${binary:Package}\n", "-W"])
+    if (rpm_packages := read_rpm_sqlite()) is not None:
+        return rpm_packages
+    if shutil.which("rpm"):
+        return command_lines(["rpm", "-qa"])
+    # Read Python distributions in-process rather than spawning pip
+    names = (d.metadata["Name"] for d in distributions())
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def list_running_services() -> list[str]:
+    """List running process names from /proc, or via ps where it is missing."""
+    try:
+        pids = sorted((e for e in os.listdir(PROC_PATH) if e.isdigit()), key=int)
+    except OSError:
+        return command_lines(["ps", "-eo", "comm"], skip=1)
+    names = []
+    for pid in pids:
+        try:
+            with open(os.path.join(PROC_PATH, pid, "comm"), "rb") as f:
+                names.append(f.read().rstrip(b"\n").decode("utf-8", errors="replace"))
+        except OSError:
+            continue  # the process exited while listing
+    return names
 
-    # Disk usage and total memory
+
+def disk_free_mb() -> int:
+    """Free space on the root filesystem in MiB, or 0 if unavailable."""
     try:
-        disk = shutil.disk_usage("/")
-        info["disk_free_mb"] = disk.free // 1024 // 1024
+        return shutil.disk_usage("/").free // 1024 // 1024
     except Exception:
-        pass
+        return 0
+
+
+def memory_total_mb() -> int:
+    """Total memory from /proc/meminfo in MiB, or 0 if unavailable."""
     try:
-        with open("/proc/meminfo", "r", encoding="utf-8") as f:
-            first = f.readline()
-            mem_kb = int(first.split()[1])
-            info["memory_total_mb"] = mem_kb // 1024
+        fd = os.open("/proc/meminfo", os.O_RDONLY)
+        try:
+            first = os.read(fd, 256).split(b"\n", 1)[0]  # "MemTotal:  N kB"
+        finally:
+            os.close(fd)
+        return int(first.split()[1]) // 1024
     except Exception:
-        pass
+        return 0
 
-    # Attempt to get installed packages using dpkg, rpm, or pip
-    if shutil.which("dpkg-query"):
-        result = subprocess.run(
-            ["dpkg-query", "-f", "${binary:Package}\n", "-W"],
-            capture_output=True,
-            text=True,
-        )
-        if result.returncode == 0:
-            info["packages"] = result.stdout.strip().splitlines()
-    elif shutil.which("rpm"):
-        result = subprocess.run(["rpm", "-qa"], capture_output=True, text=True)
-        if result.returncode == 0:
-            info["packages"] = result.stdout.strip().splitlines()
-    else:
-        result = subprocess.run(
-            ["pip", "list", "--format=json"], capture_output=True, text=True
-        )
-        if result.returncode == 0:
-            try:
-                pkgs = json.loads(result.stdout)
-                info["packages"] = [p.get("name") for p in pkgs]
-            except json.JSONDecodeError:
-                info["packages"] = result.stdout.strip().splitlines()
 
-    # List running services/process names
-    ps = subprocess.run(["ps", "-eo", "comm"], capture_output=True, text=True)
-    if ps.returncode == 0:
-        lines = ps.stdout.strip().splitlines()
-        info["running_services"] = lines[1:] if len(lines) > 1 else []
+def gather_system_info() -> dict:
+    """Collect basic system details."""
+    import platform
+
+    # Every probe blocks on I/O, so run them side by side while the platform
+    # strings (which read the interpreter binary for the libc version) are built
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        packages = pool.submit(list_packages)
+        services = pool.submit(list_running_services)
+        disk = pool.submit(disk_free_mb)
+        memory = pool.submit(memory_total_mb)
+        info = {
+            "os": platform.platform(),
+            "python_version": platform.python_version(),
+            "_pkg_db_mtime": package_db_mtime(),
+        }
+        info["disk_free_mb"] = disk.result()
+        info["memory_total_mb"] = memory.result()
+        info["packages"] = packages.result()
+        info["running_services"] = services.result()
 
     return info
 
 
-def load_knowledge(path: str) -> dict:
-    """Load existing knowledge or create new file with system info."""
+def _json_loads(raw: bytes | str):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _json_dumps(data, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    # Match orjson's output: compact unless indented
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def knowledge_log_path(path: str) -> str:
+    """Return the append-only command log that accompanies a knowledge file."""
+    return path + ".log.jsonl"
+
+
+def _system_refresh(system: dict | None, force: bool = False) -> str | None:
+    """Return "full" or "packages" if stored system details need refreshing."""
+    if force or not system or system.get("pending"):
+        return "full"
+    ttl = float(os.getenv("CORTANA_SYSTEM_TTL", DEFAULT_SYSTEM_TTL))
+    if time.time() - system.get("system_ts", 0) > ttl:
+        return "full"
+    if system.get("_pkg_db_mtime") != package_db_mtime():
+        return "packages"
+    return None
+
+
+def _refresh_system_info(data: dict, refresh: str) -> None:
+    """Gather all system details, or just the packages if their DB changed."""
+    if refresh == "full":
+        data["system"] = {**gather_system_info(), "system_ts": time.time()}
+    else:
+        # Only the package list depends on the package database
+        data["system"] = {
+            **data["system"],
+            "_pkg_db_mtime": package_db_mtime(),
+            "packages": list_packages(),
+        }
+
+
+def _refresh_system_info_later(path: str, data: dict, refresh: str) -> None:
+    _refresh_system_info(data, refresh)
+    _PENDING_SNAPSHOTS[path] = data
+
+
+def load_knowledge(
+    path: str | os.PathLike, background: bool = False, refresh_system: bool = False
+) -> dict:
+    """Load existing knowledge or create new file with system info.
+
+    System details are gathered again once they are older than
+    CORTANA_SYSTEM_TTL seconds or when refresh_system is set; only the package
+    list is refreshed when just the package database changed.
+
+    With background=True, system details are gathered on a daemon thread so
+    the caller can continue immediately; until they arrive data["system"]
+    holds {"pending": True} (or the stale details, if there are any).
+    """
+    path = os.fspath(path)
+    wait_for_knowledge_writes()
     if os.path.exists(path):
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(path, "rb") as f:
+                data = _json_loads(f.read())
         except Exception:
             data = {}
     else:
         data = {}
 
-    if "system" not in data:
-        data["system"] = gather_system_info()
-    if "commands" not in data:
-        data["commands"] = []
-    if "stats" not in data:
-        data["stats"] = {}
-    if "paths" not in data:
-        data["paths"] = {}
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    # The snapshot is only rewritten when loading changed something
+    dirty = False
+    system = data.get("system")
+    refresh = _system_refresh(system, refresh_system)
+    if refresh and not background:
+        _refresh_system_info(data, refresh)
+        dirty = True
+    elif refresh and not system:
+        data["system"] = {"pending": True}
+        dirty = True
+    for key in ("commands", "stats", "paths"):
+        if key not in data:
+            data[key] = {}
+            dirty = True
+    data["commands"] = _index_commands(data["commands"])
+
+    # Replay commands logged since the last snapshot
+    log_path = knowledge_log_path(path)
+    if os.path.exists(log_path):
+        dirty = True
+        with open(log_path, "rb") as f:
+            for line in f:
+                try:
+                    record = _json_loads(line)
+                except ValueError:
+                    continue  # torn final line from an interrupted write
+                _record_command(
+                    data, record["command"], record["output"], record["success"]
+                )
+                _apply_path_changes(data, record.get("paths", {}))
+
+    if dirty:
+        save_knowledge(path, data)
+    if refresh and background:
+        threading.Thread(
+            target=_refresh_system_info_later, args=(path, data, refresh), daemon=True
+        ).start()
     return data
 
 
-def update_knowledge(
-    path: str, data: dict, command: str, output: str, success: bool
-) -> None:
-    """Append command execution result to knowledge base."""
-    data.setdefault("commands", []).append(
-        {"command": command, "output": output, "success": success}
-    )
+def save_knowledge(path: str | os.PathLike, data: dict) -> None:
+    """Write a full knowledge snapshot and drop the command log it now covers."""
+    path = os.fspath(path)
+    _write_knowledge_snapshot(path, _dump_knowledge(data))
+    _PENDING_SNAPSHOTS.pop(path, None)
+    _logged_commands.pop(path, None)
+
+
+def _dump_knowledge(data: dict) -> bytes:
+    # Commands are held by command in memory but stored as a list, oldest first
+    commands = data.get("commands")
+    if isinstance(commands, dict):
+        data = {**data, "commands": list(commands.values())}
+    return _json_dumps(data, indent=True)
+
+
+def _write_knowledge_snapshot(path: str, snapshot: bytes) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(snapshot)
+        os.replace(tmp, path)
+    except BaseException:
+        # Don't leave a half-written snapshot behind
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    try:
+        os.remove(knowledge_log_path(path))
+    except FileNotFoundError:
+        pass
+
+
+@atexit.register
+def flush_knowledge() -> None:
+    """Snapshot every knowledge base that has logged commands."""
+    wait_for_knowledge_writes()
+    for path, data in list(_PENDING_SNAPSHOTS.items()):
+        save_knowledge(path, data)
+
+
+def _index_commands(commands) -> dict:
+    """Key a stored command list by command, oldest first.
+
+    Entries from before outputs were kept per command hold a single output.
+    """
+    if isinstance(commands, dict):
+        return commands
+    index = {}
+    for entry in commands:
+        outputs = entry["outputs"] if "outputs" in entry else [entry.get("output", "")]
+        earlier = index.pop(entry["command"], None)
+        if earlier is not None:
+            outputs = earlier["outputs"] + outputs
+        index[entry["command"]] = {
+            "command": entry["command"], "outputs": outputs, "success": entry.get("success"),
+        }
+    return index
+
+
+def _record_command(data: dict, command: str, output: str, success: bool) -> None:
+    # One entry per distinct command, moved to the end when it runs again.
+    # Entries are replaced rather than changed, so a snapshot can share them.
+    commands = data.get("commands")
+    if not isinstance(commands, dict):
+        commands = data["commands"] = _index_commands(commands or [])
+    earlier = commands.pop(command, None)
+    outputs = earlier["outputs"] + [output] if earlier else [output]
+    commands[command] = {"command": command, "outputs": outputs, "success": success}
     stats = data.setdefault("stats", {})
     entry = stats.setdefault(command, {"success": 0, "failure": 0})
     if success:
         entry["success"] += 1
     else:
         entry["failure"] += 1
+
+
+def update_knowledge(
+    path: str | os.PathLike, data: dict, command: str, output: str, success: bool
+) -> None:
+    """Append command execution result to knowledge base.
+
+    The result is appended to the command log in the background; the full
+    snapshot is rewritten every KNOWLEDGE_SNAPSHOT_EVERY commands, by
+    flush_knowledge at exit, or on the next load. Paths named by the command
+    are checked on the same background thread.
+    """
+    path = os.fspath(path)
+    logged = _logged_commands.get(path, 0) + 1
+    snapshot = None
+    with _KNOWLEDGE_LOCK:
+        _record_command(data, command, output, success)
+        if logged >= KNOWLEDGE_SNAPSHOT_EVERY:
+            # Freeze the commands and stats as of this command: later commands
+            # are logged after the snapshot and must not be in it twice
+            snapshot = {
+                "commands": list(data["commands"].values()),
+                "stats": {k: dict(v) for k, v in data["stats"].items()},
+            }
+    global _last_knowledge_write
+    record = {"command": command, "output": output, "success": success}
+    _last_knowledge_write = _KNOWLEDGE_WRITER.submit(
+        _persist_command, path, data, record, CURRENT_DIR, snapshot
+    )
+    if snapshot:
+        _PENDING_SNAPSHOTS.pop(path, None)
+        _logged_commands.pop(path, None)
+    else:
+        _PENDING_SNAPSHOTS[path] = data
+        _logged_commands[path] = logged
+
+
+@functools.lru_cache(maxsize=256)
+def _fast_split(command: str) -> tuple[str, ...]:
+    """Split a command like shlex.split, skipping shlex when nothing is quoted.
+
+    The same command is split by check_command_rules, run_command and the
+    knowledge writer, so results are cached.
+    """
+    if any(c in command for c in "'\"\\"):
+        return tuple(shlex.split(command))
+    return tuple(command.split())
+
+
+def _record_paths(data: dict, command: str, cwd: str, success: bool) -> dict:
+    """Record the paths a command names; returns the changes, None meaning removed."""
     paths = data.setdefault("paths", {})
+    changes = {}
     found = []
     try:
-        tokens = shlex.split(command)
+        tokens = _fast_split(command)
     except Exception:
-        tokens = []
+        tokens = ()
     for tok in tokens[1:]:
         if tok.startswith("-"):
             continue
         p = tok
         if not os.path.isabs(p):
-            p = os.path.join(CURRENT_DIR, p)
+            p = os.path.join(cwd, p)
         if os.path.exists(p):
             found.append(os.path.abspath(p))
     for p in found:
-        paths[p] = "directory" if os.path.isdir(p) else "file"
+        paths[p] = changes[p] = "directory" if os.path.isdir(p) else "file"
     if not success:
         for p in found:
             if not os.path.exists(p) and p in paths:
                 del paths[p]
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+                changes[p] = None
+    return changes
 
 
-def load_rules() -> dict:
-    """Load safety and preference rules from YAML files and whitelist."""
-    safety_path = os.getenv("CORTANA_SAFETY_RULES", "safety_rules.yaml")
-    prefs_path = os.getenv("CORTANA_PREFERENCES", "preferences.yaml")
-    whitelist_path = os.getenv("CORTANA_WHITELIST", DEFAULT_WHITELIST_PATH)
+def _apply_path_changes(data: dict, changes: dict) -> None:
+    paths = data.setdefault("paths", {})
+    for p, kind in changes.items():
+        if kind is None:
+            paths.pop(p, None)
+        else:
+            paths[p] = kind
+
+
+def _persist_command(
+    path: str, data: dict, record: dict, cwd: str, snapshot: dict | None
+) -> None:
+    """Record a command's paths, then log it or write a full snapshot.
+
+    snapshot holds the commands and stats frozen when the command was
+    recorded; paths are current here because the writer runs jobs in order.
+    """
+    with _KNOWLEDGE_LOCK:
+        changes = _record_paths(data, record["command"], cwd, record["success"])
+        if snapshot is not None:
+            # The snapshot covers this command too, so it replaces the log append
+            contents = _dump_knowledge({**data, **snapshot})
+    if snapshot is not None:
+        _write_knowledge_snapshot(path, contents)
+    else:
+        # Logged with the command so a crash before the next snapshot keeps them
+        if changes:
+            record = {**record, "paths": changes}
+        _append_knowledge_log(knowledge_log_path(path), _json_dumps(record))
+
+
+def _append_knowledge_log(log_path: str, line: bytes) -> None:
+    with open(log_path, "ab") as f:
+        f.write(line + b"\n")
+
+
+def wait_for_knowledge_writes() -> None:
+    """Block until every queued knowledge file write has finished."""
+    if _last_knowledge_write is not None:
+        _last_knowledge_write.result()
+
+
+def _file_signature(path: str) -> list:
+    """Identify a file's current contents by absolute path, mtime and size."""
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [path, None, None]
+    return [path, st.st_mtime_ns, st.st_size]
+
 
-    rules = {"blocked": [], "confirm": [], "auto": DEFAULT_AUTO_COMMANDS.copy()}
+def _read_rule_files(safety_path: str, prefs_path: str, whitelist_path: str) -> dict:
+    """Parse the YAML rule files and whitelist into plain lists."""
+    import yaml
+
+    try:  # libyaml-backed loader, same semantics as yaml.safe_load
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:  # pragma: no cover - PyYAML built without libyaml
+        from yaml import SafeLoader as YamlLoader
+
+    rules = {"blocked": [], "confirm": [], "auto": []}
 
     for path in [safety_path, prefs_path]:
         if os.path.exists(path):
             try:
                 with open(path, "r", encoding="utf-8") as f:
-                    data = yaml.safe_load(f) or {}
+                    data = yaml.load(f, Loader=YamlLoader) or {}
                 rules["blocked"].extend(data.get("blocked", []))
                 rules["confirm"].extend(data.get("confirm", []))
                 rules["auto"].extend(
@@ -249,24 +764,169 @@ def load_rules() -> dict:
                         rules["auto"].append(cmd)
         except Exception:
             pass
+    return rules
+
+
+def load_rules() -> dict:
+    """Load safety and preference rules from YAML files and whitelist.
+
+    Parsed rule files are cached under CORTANA_CACHE_DIR and reused until one
+    of the files changes. Within a process the built rules are memoized on the
+    same file signatures and each caller gets its own copy of the lists.
+    """
+    safety_path = os.getenv("CORTANA_SAFETY_RULES", "safety_rules.yaml")
+    prefs_path = os.getenv("CORTANA_PREFERENCES", "preferences.yaml")
+    whitelist_path = os.getenv("CORTANA_WHITELIST", DEFAULT_WHITELIST_PATH)
+    cache_path = os.path.join(
+        os.path.expanduser(os.getenv("CORTANA_CACHE_DIR", DEFAULT_CACHE_DIR)),
+        "rules.json",
+    )
+
+    key = [_file_signature(p) for p in (safety_path, prefs_path, whitelist_path)]
+    memo_key = tuple(tuple(sig) for sig in key)
+    rules = _rules_cache.get(memo_key)
+    if rules is None:
+        rules = _build_rules(key, cache_path, safety_path, prefs_path, whitelist_path)
+        _rules_cache.clear()
+        _rules_cache[memo_key] = rules
+    return {k: list(v) if isinstance(v, list) else v for k, v in rules.items()}
+
+
+def _build_rules(
+    key: list, cache_path: str, safety_path: str, prefs_path: str, whitelist_path: str
+) -> dict:
+    """Parse the rule files (or reuse the on-disk cache) and compile matchers."""
+    parsed = None
+    try:
+        with open(cache_path, "rb") as f:
+            cached = _json_loads(f.read())
+        if cached["key"] == key:
+            parsed = cached["rules"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if parsed is None:
+        parsed = _read_rule_files(safety_path, prefs_path, whitelist_path)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(_json_dumps({"key": key, "rules": parsed}))
+                os.replace(tmp, cache_path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        except OSError:
+            pass
 
-    # Remove duplicates while preserving order
-    rules["auto"] = list(dict.fromkeys(rules["auto"]))
+    rules = {
+        "blocked": parsed["blocked"],
+        "confirm": parsed["confirm"],
+        # Remove duplicates while preserving order
+        "auto": list(dict.fromkeys(DEFAULT_AUTO_COMMANDS + parsed["auto"])),
+    }
+    rules["auto_set"] = frozenset(rules["auto"])
+    rules["has_user_rules"] = bool(rules["blocked"] or rules["confirm"])
+    rules["blocked_automaton"] = build_automaton(rules["blocked"])
+    rules["confirm_automaton"] = build_automaton(rules["confirm"])
     return rules
 
 
+def build_automaton(patterns: list[str]):
+    """Compile substring patterns into a single matcher.
+
+    Uses an Aho-Corasick automaton when pyahocorasick is installed and a
+    regex alternation otherwise; returns None when there are no patterns.
+    """
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    if ahocorasick is None:
+        return re.compile("|".join(map(re.escape, patterns)))
+    automaton = ahocorasick.Automaton()
+    for pat in patterns:
+        automaton.add_word(pat, pat)
+    automaton.make_automaton()
+    return automaton
+
+
+def _matches_any(command: str, patterns: list[str], automaton) -> bool:
+    if isinstance(automaton, re.Pattern):
+        return automaton.search(command) is not None
+    if automaton is not None:
+        return next(automaton.iter(command), None) is not None
+    return any(pat and pat in command for pat in patterns)
+
+
+# Built-in dangerous patterns never change, so their automaton is built once
+DANGER_AUTOMATON = build_automaton(DANGEROUS_PATTERNS)
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_automaton(patterns: tuple[str, ...]):
+    return build_automaton(list(patterns))
+
+
+def _rule_matcher(rules: dict, key: str):
+    """Return the matcher for rules[key], compiling ad hoc rule lists once."""
+    automaton = rules.get(f"{key}_automaton")
+    if automaton is None and rules.get(key):
+        automaton = _cached_automaton(tuple(rules[key]))
+    return automaton
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    try:
+        return tiktoken.encoding_for_model(CHAT_MODEL)
+    except Exception:  # missing package or offline encoding download
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken, or estimate roughly four characters each."""
+    encoding = _token_encoding() if tiktoken is not None else None
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def trim_history(messages: list[dict], max_tokens: int = MAX_HISTORY_TOKENS) -> None:
+    """Drop the oldest turns until the conversation fits the token budget.
+
+    The system prompt and the latest message are always kept.
+    """
+    total = sum(count_tokens(m["content"]) for m in messages[1:])
+    while len(messages) > 2 and total > max_tokens:
+        total -= count_tokens(messages.pop(1)["content"])
+
+
 def summarize_knowledge(data: dict) -> str:
     info = data.get("system", {})
     os_info = info.get("os", "")
-    paths = list(data.get("paths", {}).keys())[:5]
+    paths = list(itertools.islice(data.get("paths", {}), 5))
     summary = f"OS: {os_info}."
     if paths:
         summary += " Known paths: " + ", ".join(paths)
     return summary
 
 
-def build_system_prompt(history: list[dict], knowledge: dict) -> str:
-    """Generate the system prompt including recent command history."""
+def build_system_prompt(history: dict | list[dict], knowledge: dict) -> str:
+    """Generate the system prompt including recent command history.
+
+    history is knowledge["commands"] (keyed by command) or a list of entries.
+    """
+    entries = history.values() if isinstance(history, dict) else history
+    last = list(itertools.islice(reversed(entries), 5))[::-1]
+    recent = tuple((h.get("command"), bool(h.get("success"))) for h in last)
+    return _system_prompt(summarize_knowledge(knowledge), recent)
+
+
+@functools.lru_cache(maxsize=16)
+def _system_prompt(summary: str, recent: tuple[tuple[str, bool], ...]) -> str:
     prompt = (
         "You are Cortana, a general purpose command line assistant."
         " Learn the user's goal, gather information step by step, and"
@@ -278,45 +938,182 @@ def build_system_prompt(history: list[dict], knowledge: dict) -> str:
         " 'edit <file> <content>' command."
         " Escape any double quotes in your JSON values with a backslash."
     )
-    prompt += " " + summarize_knowledge(knowledge)
-    if history:
-        entries = []
-        for h in history[-5:]:
-            status = "ok" if h.get("success") else "failed"
-            entries.append(f"{h.get('command')} ({status})")
+    prompt += " " + summary
+    if recent:
+        entries = [f"{command} ({'ok' if success else 'failed'})" for command, success in recent]
         prompt += " Recent command history: " + "; ".join(entries)
     return prompt
 
 
 def check_command_rules(command: str, rules: dict) -> str | None:
     """Return 'block', 'danger', 'confirm', or 'auto' if command matches a rule."""
-    for pat in rules.get("blocked", []):
-        if pat and pat in command:
-            return "block"
+    # Without user rules (the first-run default) only the built-in checks apply
+    has_user_rules = rules.get("has_user_rules", True)
+    if has_user_rules and _matches_any(
+        command, rules.get("blocked", []), _rule_matcher(rules, "blocked")
+    ):
+        return "block"
 
-    parts = shlex.split(command)
+    parts = _fast_split(command)
     if parts and parts[0] in INTERACTIVE_COMMANDS:
         return "block"
 
-    for pat in DANGEROUS_PATTERNS:
-        if pat in command:
-            return "danger"
+    if _matches_any(command, DANGEROUS_PATTERNS, DANGER_AUTOMATON):
+        return "danger"
 
-    for pat in rules.get("confirm", []):
-        if pat and pat in command:
-            return "confirm"
+    if has_user_rules and _matches_any(
+        command, rules.get("confirm", []), _rule_matcher(rules, "confirm")
+    ):
+        return "confirm"
 
-    parts = shlex.split(command)
-    if parts and parts[0] in rules.get("auto", []):
+    if parts and parts[0] in rules.get("auto_set", rules.get("auto", ())):
         return "auto"
     return None
 
 
-def run_command(command: str) -> tuple[str, bool]:
-    """Run a shell command with persistent state and return output and success."""
+def output_echo():
+    """Return a function that copies raw command output to stdout.
+
+    Bytes go straight to the binary buffer when there is one; otherwise they
+    are decoded incrementally. Call it with b"" once the output ends.
+    """
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is not None:
+        sys.stdout.flush()  # keep earlier text output in order
+
+        def echo(chunk: bytes) -> None:
+            buffer.write(chunk)
+            buffer.flush()
+
+        return echo
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def echo(chunk: bytes) -> None:
+        sys.stdout.write(decoder.decode(chunk, final=not chunk))
+        sys.stdout.flush()
+
+    return echo
+
+
+def _builtin_path(arg: str) -> str:
+    return os.path.join(CURRENT_DIR, arg)
+
+
+def _builtin_pwd(args: tuple[str, ...]) -> bytes | None:
+    return None if args else (CURRENT_DIR + "\n").encode()
+
+
+def _builtin_whoami(args: tuple[str, ...]) -> bytes | None:
+    import pwd
+
+    if args:
+        return None
+    try:
+        name = pwd.getpwuid(os.geteuid()).pw_name
+    except KeyError:
+        return None  # uid without a passwd entry; let whoami report it
+    return (name + "\n").encode()
+
+
+def _builtin_date(args: tuple[str, ...]) -> bytes | None:
+    return None if args else (time.strftime("%a %b %e %H:%M:%S %Z %Y") + "\n").encode()
+
+
+def _open_regular(arg: str):
+    """Open a regular file for reading, or return None.
+
+    Devices and pipes (such as /dev/zero) can be endless, so they are left to
+    the real command, as are files that cannot be opened.
+    """
+    try:
+        f = open(_builtin_path(arg), "rb")
+    except OSError:
+        return None
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        f.close()
+        return None
+    return f
+
+
+def _read_chunks(files) -> Iterator[bytes]:
+    try:
+        for f in files:
+            while chunk := f.read(READ_CHUNK_SIZE):
+                yield chunk
+    finally:
+        for f in files:
+            f.close()
+
+
+def _builtin_cat(args: tuple[str, ...]) -> Iterator[bytes] | None:
+    if not args or any(a.startswith("-") for a in args):
+        return None
+    files = []
+    for arg in args:
+        if (f := _open_regular(arg)) is None:
+            for opened in files:
+                opened.close()
+            return None  # let the real cat report the error
+        files.append(f)
+    # Streamed, so a large file is echoed as it is read instead of held whole
+    return _read_chunks(files)
+
+
+def _line_count_args(args: tuple[str, ...]) -> tuple[int, str] | None:
+    """Parse "FILE", "-n N FILE" or "-N FILE" for head and tail."""
+    if len(args) == 1 and not args[0].startswith("-"):
+        return 10, args[0]
+    if len(args) == 3 and args[0] == "-n" and args[1].isdigit():
+        return int(args[1]), args[2]
+    if len(args) == 2 and args[0][1:].isdigit() and args[0].startswith("-"):
+        return int(args[0][1:]), args[1]
+    return None
+
+
+def _builtin_head(args: tuple[str, ...]) -> bytes | None:
+    if (parsed := _line_count_args(args)) is None:
+        return None
+    count, path = parsed
+    if (f := _open_regular(path)) is None:
+        return None
+    with f:
+        # Reads only as far as the last line wanted
+        return b"".join(itertools.islice(f, count))
+
+
+def _builtin_tail(args: tuple[str, ...]) -> bytes | None:
+    if (parsed := _line_count_args(args)) is None:
+        return None
+    count, path = parsed
+    if (f := _open_regular(path)) is None:
+        return None
+    with f:
+        return b"".join(collections.deque(f, maxlen=count)) if count else b""
+
+
+# Simple commands answered in-process instead of spawning a shell. Handlers
+# return the output bytes (or an iterator of chunks), or None to fall back to
+# the real command.
+BUILTIN_COMMANDS = {
+    "pwd": _builtin_pwd,
+    "whoami": _builtin_whoami,
+    "date": _builtin_date,
+    "cat": _builtin_cat,
+    "head": _builtin_head,
+    "tail": _builtin_tail,
+}
+
+
+def run_builtin(command: str) -> tuple[str, bool] | None:
+    """Handle cd, edit and the in-process builtins; None means use the shell.
+
+    Builtins other than cd and edit are skipped for commands that use shell
+    syntax, or when CORTANA_NO_BUILTINS is set.
+    """
     global CURRENT_DIR
     stripped = command.strip()
-    parts = shlex.split(stripped)
+    parts = _fast_split(stripped)
     if parts and parts[0] == "cd":
         target = parts[1] if len(parts) > 1 else os.path.expanduser("~")
         if not os.path.isabs(target):
@@ -336,87 +1133,160 @@ def run_command(command: str) -> tuple[str, bool]:
         with open(path, "w", encoding="utf-8") as f:
             f.write(content)
         return "", True
+    handler = BUILTIN_COMMANDS.get(parts[0]) if parts else None
+    if handler is None or os.getenv("CORTANA_NO_BUILTINS") or SHELL_META_RE.search(stripped):
+        return None
+    output = handler(parts[1:])
+    if output is None:
+        return None
+    echo = output_echo()
+    collected = bytearray()
+    for chunk in [output] if isinstance(output, bytes) else output:
+        echo(chunk)
+        collected += chunk
+    echo(b"")
+    return collected.decode("utf-8", errors="replace"), True
+
+
+def run_command(command: str) -> tuple[str, bool]:
+    """Run a shell command with persistent state and return output and success."""
+    result = run_builtin(command)
+    if result is not None:
+        return result
     process = subprocess.Popen(
         command,
         shell=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
+        bufsize=0,
         cwd=CURRENT_DIR,
     )
-    output_lines = []
-    if process.stdout:
-        for line in process.stdout:
-            print(line, end="")
-            output_lines.append(line)
+    # os.read returns whatever the child has written so far, so progress
+    # output without a trailing newline shows up immediately
+    echo = output_echo()
+    output = bytearray()
+    fd = process.stdout.fileno()
+    while chunk := os.read(fd, READ_CHUNK_SIZE):
+        output += chunk
+        echo(chunk)
+    echo(b"")
+    process.stdout.close()
     process.wait()
     success = process.returncode == 0
     if not success:
         print(f"Command exited with code {process.returncode}")
-    return "".join(output_lines), success
+        logger.warning("Command %r exited with code %d", command, process.returncode)
+    return output.decode("utf-8", errors="replace"), success
 
 
 async def run_command_async(command: str) -> tuple[str, bool]:
     """Asynchronously run a shell command and stream output."""
-    global CURRENT_DIR
-    stripped = command.strip()
-    parts = shlex.split(stripped)
-    if parts and parts[0] == "cd":
-        target = parts[1] if len(parts) > 1 else os.path.expanduser("~")
-        if not os.path.isabs(target):
-            target = os.path.join(CURRENT_DIR, target)
-        if os.path.isdir(target):
-            CURRENT_DIR = os.path.abspath(target)
-            return "", True
-        return f"cd: no such file or directory: {target}", False
-    if parts and parts[0] == "edit":
-        if len(parts) < 3:
-            return "edit usage: edit <file> <content>", False
-        path = parts[1]
-        content = " ".join(parts[2:])
-        if not os.path.isabs(path):
-            path = os.path.join(CURRENT_DIR, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
-        return "", True
+    result = run_builtin(command)
+    if result is not None:
+        return result
     process = await asyncio.create_subprocess_shell(
         command,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT,
         cwd=CURRENT_DIR,
     )
-    output_lines: list[str] = []
-    if process.stdout:
-        async for line in process.stdout:
-            text = line.decode()
-            print(text, end="")
-            output_lines.append(text)
+    # Echo whatever output is available in one write rather than per line
+    echo = output_echo()
+    output = bytearray()
+    while chunk := await process.stdout.read(READ_CHUNK_SIZE):
+        output += chunk
+        echo(chunk)
+    echo(b"")
     await process.wait()
     success = process.returncode == 0
     if not success:
         print(f"Command exited with code {process.returncode}")
-    return "".join(output_lines), success
+        logger.warning("Command %r exited with code %d", command, process.returncode)
+    return output.decode("utf-8", errors="replace"), success
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Cortana CLI")
     parser.add_argument("--plan", help="Task description to plan and run")
     parser.add_argument("--edit-plan", action="store_true", help="Interactively edit pending plan")
+    parser.add_argument(
+        "--script",
+        help="File of prompts, one per line, to answer concurrently without running commands",
+    )
+    parser.add_argument(
+        "--script-output", help="JSONL file for --script results (default: <script>.results.jsonl)"
+    )
+    parser.add_argument(
+        "--refresh-system",
+        action="store_true",
+        help="Gather system details again instead of using the stored ones",
+    )
     return parser.parse_known_args()[0]
 
 
+async def answer_prompts(
+    client, system_prompt: str, prompts: list[str], concurrency: int = SCRIPT_CONCURRENCY
+) -> list[dict]:
+    """Request suggestions for independent prompts concurrently."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(prompt: str) -> dict:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        try:
+            async with semaphore:
+                response = await client.chat.completions.create(
+                    model=CHAT_MODEL, messages=messages, response_format=RESPONSE_FORMAT
+                )
+        except Exception as e:  # pragma: no cover - network errors
+            return {"prompt": prompt, "error": str(e)}
+        msg = response.choices[0].message
+        raw = msg["content"].strip() if isinstance(msg, dict) else msg.content.strip()
+        data = parse_cortana_response(raw)
+        if not data:
+            return {"prompt": prompt, "error": "Invalid JSON response from AI", "raw": raw}
+        return {"prompt": prompt, "explanation": data.explanation, "command": data.command}
+
+    return await asyncio.gather(*(answer(p) for p in prompts))
+
+
+def run_script(client, script_path: str, output_path: str, knowledge: dict) -> None:
+    """Answer every prompt in a script file and write the results as JSONL."""
+    with open(script_path, "r", encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()]
+    system_prompt = build_system_prompt(knowledge.get("commands", {}), knowledge)
+    results = asyncio.run(answer_prompts(client, system_prompt, prompts))
+    with open(output_path, "wb") as f:
+        for result in results:
+            f.write(_json_dumps(result) + b"\n")
+    print(f"Wrote {len(results)} results to {output_path}")
+
+
+def format_step(idx: int, step: PlanStep) -> str:
+    status = f" [{step.status}]" if step.status != "pending" else ""
+    return f"{idx}. {step.description}: {step.command}{status}"
+
+
 def display_plan(steps: list[PlanStep]) -> None:
     for idx, step in enumerate(steps, 1):
-        status = f" [{step.status}]" if step.status != "pending" else ""
-        print(f"{idx}. {step.description}: {step.command}{status}")
+        print(format_step(idx, step))
+
+
+def propose_plan(task: str) -> list[PlanStep]:
+    """Print each step of a new plan as soon as the model has written it."""
+    print("Proposed plan:")
+    steps = []
+    for step in iter_plan(task):
+        steps.append(step)
+        print(format_step(len(steps), step), flush=True)
+    return steps
 
 
 def review_plan(task: str, plan_file: str) -> list[PlanStep] | None:
-    steps = generate_plan(task)
+    steps = propose_plan(task)
     while True:
-        print("Proposed plan:")
-        display_plan(steps)
         choice = input(
             "Approve this plan? (press enter for yes, 'u' to update, 'n' to cancel): "
         ).strip().lower()
@@ -424,32 +1294,52 @@ def review_plan(task: str, plan_file: str) -> list[PlanStep] | None:
             save_plan(plan_file, steps)
             return steps
         if choice == "n":
+            forget_plan(task)  # so asking again gets a new plan
             print("Plan cancelled.")
             return None
         if choice == "u":
+            forget_plan(task)
             update = input("Describe the updates: ").strip()
             if update:
                 task = f"{task}. {update}"
-            steps = generate_plan(task)
+            steps = propose_plan(task)
+            continue
+        print("Proposed plan:")
+        display_plan(steps)
 
 
 def main():
     args = parse_args()
+    plan_file = "task_plan.json"
+    if args.edit_plan:
+        # Editing a saved plan needs neither the API nor the knowledge base
+        interactive_edit_plan(plan_file)
+        return
+
+    # Imported here so --help and plan editing skip loading the API client
+    import openai
+    from dotenv import load_dotenv
+
     load_dotenv()
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         print("OPENAI_API_KEY not set. Please set it in your environment or .env file.")
         return
     client = openai.OpenAI(api_key=api_key)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     knowledge_file = os.getenv("CORTANA_KNOWLEDGE_FILE", "server_knowledge.json")
-    knowledge = load_knowledge(knowledge_file)
+    knowledge = load_knowledge(
+        knowledge_file, background=not args.script, refresh_system=args.refresh_system
+    )
     rules = load_rules()
 
-    plan_file = "task_plan.json"
-    if args.edit_plan:
-        interactive_edit_plan(plan_file)
+    if args.script:
+        output_path = args.script_output or f"{args.script}.results.jsonl"
+        run_script(openai.AsyncOpenAI(api_key=api_key), args.script, output_path, knowledge)
         return
+
     if args.plan:
         steps = review_plan(args.plan, plan_file)
         if steps:
@@ -458,9 +1348,9 @@ def main():
                 plan_file,
                 knowledge,
                 knowledge_file,
-                run_command,
+                run_command_async,
                 update_knowledge,
-                confirm_each_step=True,
+                confirm_mode="batch",
             )
         return
     if os.path.exists(plan_file):
@@ -473,37 +1363,50 @@ def main():
                     plan_file,
                     knowledge,
                     knowledge_file,
-                    run_command,
+                    run_command_async,
                     update_knowledge,
-                    confirm_each_step=True,
+                    confirm_mode="batch",
                 )
                 return
 
-    system_prompt = build_system_prompt(knowledge.get("commands", []), knowledge)
+    system_prompt = build_system_prompt(knowledge.get("commands", {}), knowledge)
     messages = [{"role": "system", "content": system_prompt}]
+    system_pending = knowledge["system"].get("pending", False)
     print("Type 'exit' to quit")
 
     def converse_loop() -> None:
         while True:
+            trim_history(messages)
             try:
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
+                stream = client.chat.completions.create(
+                    model=CHAT_MODEL,
                     messages=messages,
+                    response_format=RESPONSE_FORMAT,
+                    stream=True,
                 )
+                raw, shown = stream_explanation(stream)
             except Exception as e:  # pragma: no cover - network errors
                 print(f"Error: {e}")
                 return
 
-            msg = response.choices[0].message
-            raw = msg["content"].strip() if isinstance(msg, dict) else msg.content.strip()
+            raw = raw.strip()
             data = parse_cortana_response(raw)
             if not data:
+                if shown:
+                    print()
                 print("Invalid JSON response from AI. Please try rephrasing your request.")
                 print(f"AI: {raw}")
                 messages.append({"role": "assistant", "content": raw})
                 return
 
-            print(f"AI: {data.explanation}")
+            # The streamed text stops at the first unescaped quote; finish it
+            # from the parsed reply, or reprint if it diverged.
+            if shown and data.explanation.startswith(shown):
+                print(data.explanation[len(shown):])
+            else:
+                if shown:
+                    print()
+                print(f"AI: {data.explanation}")
             messages.append({"role": "assistant", "content": raw})
 
             command = data.command
@@ -554,7 +1457,7 @@ def main():
             break
         if user_input.strip().lower() in {"new", "reset"}:
             print("Starting a new conversation.")
-            system_prompt = build_system_prompt(knowledge.get("commands", []), knowledge)
+            system_prompt = build_system_prompt(knowledge.get("commands", {}), knowledge)
             messages = [{"role": "system", "content": system_prompt}]
             continue
         if user_input.strip().lower().startswith("plan "):
@@ -566,11 +1469,17 @@ def main():
                     plan_file,
                     knowledge,
                     knowledge_file,
-                    run_command,
+                    run_command_async,
                     update_knowledge,
-                    confirm_each_step=True,
+                    confirm_mode="batch",
                 )
             continue
+        if system_pending and not knowledge["system"].get("pending"):
+            # System details arrived after the prompt was first built
+            messages[0]["content"] = build_system_prompt(
+                knowledge.get("commands", {}), knowledge
+            )
+            system_pending = False
         messages.append({"role": "user", "content": user_input})
         converse_loop()
 
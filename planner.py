@@ -1,97 +1,605 @@
-from dataclasses import dataclass, asdict
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List
+import asyncio
+import base64
+import hashlib
+import inspect
 import json
+import mmap
 import os
-import openai
+import threading
+import time
 
+try:  # optional: faster plan file (de)serialization
+    import orjson
+except ImportError:  # pragma: no cover - depends on environment
+    orjson = None
+
+try:  # optional: pre-filled, editable answers in interactive_edit_plan
+    import readline
+except ImportError:  # pragma: no cover - depends on environment
+    readline = None
+
+# Kept static and sent first, unchanged between calls, with the task in a
+# separate message. OpenAI only caches prompts of 1024 tokens or more and this
+# prefix is about 200, so it gets no cache hits yet; the layout just keeps a
+# longer prompt cacheable. The guidelines and example are here for the replies.
 PLAN_PROMPT = (
     "Break the following task into a short sequence of shell commands. "
-    "Respond in JSON with a 'steps' array where each item has 'description' and 'command'."
+    "Respond in JSON with a 'steps' array where each item has 'description' and 'command'. "
+    "Add 'independent': true to a step that depends on none of the steps since the "
+    "last step without it, so that whole group can run at the same time. A step that "
+    "needs any earlier step in its group to finish first must have 'independent': false.\n"
+    "Guidelines:\n"
+    "- Use one step per command. A cd carries over to later steps, but environment "
+    "variables and other shell state do not.\n"
+    "- Prefer read-only checks before commands that change the system.\n"
+    "- Keep descriptions short and say what the step is for.\n"
+    "- Do not use interactive programs or commands that wait for input.\n"
+    "Example task: check disk and memory usage, then list the largest files in /var/log\n"
+    'Example reply: {"steps": ['
+    '{"description": "Show disk usage", "command": "df -h", "independent": false}, '
+    '{"description": "Show memory usage", "command": "free -m", "independent": true}, '
+    '{"description": "List the largest log files", '
+    '"command": "du -ah /var/log | sort -rh | head -n 10", "independent": true}]}'
 )
 
-@dataclass
+# Structured outputs need a model newer than the CLI's chat model
+PLAN_MODEL = "gpt-4o-mini"
+
+# Holds the reply to the steps schema, so it no longer drifts into prose
+PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "plan",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "description": {"type": "string"},
+                            "command": {"type": "string"},
+                            "independent": {"type": "boolean"},
+                        },
+                        "required": ["description", "command", "independent"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["steps"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Generated plans are reused for an identical task within this many seconds
+PLAN_CACHE_TTL = 3600
+
+# Read-only commands whose output execute_plan may reuse when a plan repeats
+# them with nothing else run in between (CORTANA_CACHEABLE, comma separated)
+DEFAULT_CACHEABLE_COMMANDS = ["ls", "cat", "pwd", "df", "free", "ps", "whoami", "uname", "git status", "ip a"]
+
+# Shell syntax that can make an otherwise read-only command write or chain
+_SIDE_EFFECT_CHARS = set(">|;&`$\n")
+
+# Prefix marking a step output stored as base64 because it was not UTF-8
+BASE64_OUTPUT_PREFIX = "base64:"
+
+# Writes plan files while execute_plan hands results to update_knowledge_fn
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plan-io")
+
+# Shared API client, so repeated plans reuse its connection pool
+_client = None
+_client_lock = threading.Lock()
+
+
+@dataclass(slots=True)
 class PlanStep:
     description: str
     command: str
     status: str = "pending"
     output: str = ""
     success: bool | None = None
+    # Depends on none of the steps since the last one without the flag, so it
+    # may run concurrently with all of them
+    independent: bool = False
+
+
+def _json_loads(raw: bytes | str):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _read_json_file(path: str):
+    with open(path, "rb") as f:
+        if orjson is None:
+            return json.loads(f.read())
+        # orjson parses straight from the mapped pages, skipping a read() copy
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+
+def _json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _step_dict(step: PlanStep) -> dict:
+    # PlanStep's fields are all flat, so asdict's recursive copy is not needed
+    return {
+        "description": step.description,
+        "command": step.command,
+        "status": step.status,
+        "output": step.output,
+        "success": step.success,
+        "independent": step.independent,
+    }
+
+
+def _dump_steps(steps: List[PlanStep]) -> bytes:
+    if orjson is not None:
+        # orjson serializes dataclasses natively, without asdict copies
+        return orjson.dumps(steps, option=orjson.OPT_INDENT_2)
+    return json.dumps([_step_dict(s) for s in steps], indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def _load_steps(data: list[dict]) -> List[PlanStep]:
+    return [PlanStep(**d) for d in data]
+
 
+def plan_log_path(path: str) -> str:
+    """Return the journal of step results that accompanies a plan file."""
+    return path + ".log"
 
-def save_plan(path: str, steps: List[PlanStep]) -> None:
-    data = [asdict(s) for s in steps]
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
 
+def save_plan(path: str | os.PathLike, steps: List[PlanStep]) -> None:
+    """Write the whole plan and drop the step journal it now covers.
 
-def load_plan(path: str) -> List[PlanStep]:
+    The plan is written to a temporary file and renamed over the old one, so
+    an interrupted save leaves the previous plan intact.
+    """
+    path = os.fspath(path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_dump_steps(steps))
+        os.replace(tmp, path)
+    except BaseException:
+        # Don't leave a half-written plan behind
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    try:
+        os.remove(plan_log_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def _append_step_updates(path: str, updates: list[tuple[int, PlanStep]]) -> None:
+    """Journal the results of a batch of steps with a single write."""
+    lines = []
+    for index, step in updates:
+        record = {"i": index, "status": step.status, "output": step.output, "success": step.success}
+        lines.append(_json_dumps(record))
+    with open(plan_log_path(path), "ab") as f:
+        f.write(b"\n".join(lines) + b"\n")
+
+
+def load_plan(path: str | os.PathLike) -> List[PlanStep]:
+    """Load a plan, applying step results journaled since it was last saved."""
+    path = os.fspath(path)
     if not os.path.exists(path):
         return []
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return [PlanStep(**d) for d in data]
+        steps = _load_steps(_read_json_file(path))
     except Exception:
         return []
+    log_path = plan_log_path(path)
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            for line in f:
+                try:
+                    record = _json_loads(line)
+                    step = steps[record["i"]]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    continue  # torn final line from an interrupted write
+                step.status = record["status"]
+                step.output = record["output"]
+                step.success = record["success"]
+    return steps
 
 
-def generate_plan(task: str) -> List[PlanStep]:
-    """Use the language model to create a plan for the given task."""
+def _get_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import openai  # deferred: only plan generation needs the SDK
+
+            _client = openai.OpenAI()
+        return _client
+
+
+def plan_cache_path() -> str:
+    """Return the file of cached plans (CORTANA_PLAN_CACHE overrides it)."""
+    path = os.getenv("CORTANA_PLAN_CACHE") or os.path.join(
+        os.getenv("CORTANA_CACHE_DIR", "~/.cache/cortana"), "plans.json"
+    )
+    return os.path.expanduser(path)
+
+
+def _read_plan_cache(path: str) -> dict:
+    try:
+        with open(path, "rb") as f:
+            cache = _json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_plan_cache(path: str, cache: dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(_json_dumps(cache))
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    except OSError:
+        pass
+
+
+def _delta_text(chunk) -> str:
+    if not chunk.choices:
+        return ""
+    delta = chunk.choices[0].delta
+    content = delta.get("content") if isinstance(delta, dict) else delta.content
+    return content or ""
+
+
+def _stream_step_dicts(chunks) -> Iterator[dict]:
+    """Yield each item of the reply's "steps" array as soon as it is complete."""
+    decoder = json.JSONDecoder()
+    raw = ""
+    pos = None  # index of the next unparsed step once the array has started
+    yielded = 0
+    for chunk in chunks:
+        raw += _delta_text(chunk)
+        if pos is None:
+            start = raw.find('"steps"')
+            bracket = raw.find("[", start) if start != -1 else -1
+            if bracket == -1:
+                continue
+            pos = bracket + 1
+        while True:
+            while pos < len(raw) and raw[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(raw) or raw[pos] == "]":
+                break
+            try:
+                item, pos = decoder.raw_decode(raw, pos)
+            except ValueError:
+                break  # the item is still arriving
+            yielded += 1
+            yield item
+    # Validate the whole reply and pick up anything the scan could not split
+    data = _json_loads(raw.strip())
+    if not isinstance(data, dict) or not isinstance(data.get("steps"), list):
+        raise ValueError("Plan reply has no 'steps' array")
+    yield from data["steps"][yielded:]
+
+
+def _step_fields(item) -> dict:
+    """Check a step from the model's reply and keep only the fields it may set."""
+    if not isinstance(item, dict):
+        raise ValueError(f"Plan step is not an object: {item!r}")
+    for key in ("description", "command"):
+        if not isinstance(item.get(key), str):
+            raise ValueError(f"Plan step needs a string {key!r}: {item!r}")
+    independent = item.get("independent", False)
+    if not isinstance(independent, bool):
+        raise ValueError(f"Plan step 'independent' must be true or false: {item!r}")
+    return {
+        "description": item["description"],
+        "command": item["command"],
+        "independent": independent,
+    }
+
+
+def _plan_cache_key(task: str) -> str:
+    return hashlib.sha256(task.strip().encode("utf-8")).hexdigest()
+
+
+def _cached_steps(entry, now: float) -> list[dict] | None:
+    """Return a cache entry's validated step fields, or None for a miss."""
+    if not isinstance(entry, dict) or now - entry.get("ts", 0) >= PLAN_CACHE_TTL:
+        return None
+    steps = entry.get("steps")
+    if not isinstance(steps, list):
+        return None
+    try:
+        return [_step_fields(s) for s in steps]
+    except ValueError:
+        return None  # stale or hand-edited entry
+
+
+def forget_plan(task: str) -> None:
+    """Drop the cached plan for a task, e.g. after the user rejects it."""
+    cache_path = plan_cache_path()
+    cache = _read_plan_cache(cache_path)
+    if cache.pop(_plan_cache_key(task), None) is not None:
+        _write_plan_cache(cache_path, cache)
+
+
+def iter_plan(task: str) -> Iterator[PlanStep]:
+    """Stream a plan for the given task, yielding steps as the model writes them.
+
+    Plans are cached on disk by task text for PLAN_CACHE_TTL seconds.
+    """
+    key = _plan_cache_key(task)
+    cache_path = plan_cache_path()
+    cache = _read_plan_cache(cache_path)
+    now = time.time()
+    cached = _cached_steps(cache.get(key), now)
+    if cached is not None:
+        for fields in cached:
+            yield PlanStep(**fields)
+        return
+
     messages = [
         {"role": "system", "content": PLAN_PROMPT},
         {"role": "user", "content": task},
     ]
-    client = openai.OpenAI()
-    response = client.chat.completions.create(model="gpt-3.5-turbo", messages=messages)
-    raw = response.choices[0].message["content"].strip()
-    data = json.loads(raw)
-    steps = [PlanStep(**s) for s in data.get("steps", [])]
-    return steps
+    client = _get_client()
+    stream = client.chat.completions.create(
+        model=PLAN_MODEL,
+        messages=messages,
+        response_format=PLAN_RESPONSE_FORMAT,
+        stream=True,
+    )
+    items = []
+    for item in _stream_step_dicts(stream):
+        fields = _step_fields(item)
+        items.append(fields)
+        yield PlanStep(**fields)
+
+    # Drop expired plans while the cache is being rewritten anyway
+    cache = {
+        k: v
+        for k, v in cache.items()
+        if isinstance(v, dict) and now - v.get("ts", 0) < PLAN_CACHE_TTL
+    }
+    cache[key] = {"ts": now, "steps": items}
+    _write_plan_cache(cache_path, cache)
+
+
+def generate_plan(task: str) -> List[PlanStep]:
+    """Use the language model to create a plan for the given task."""
+    return list(iter_plan(task))
+
+
+def _cacheable_commands() -> list[str]:
+    env = os.getenv("CORTANA_CACHEABLE")
+    if env is None:
+        return DEFAULT_CACHEABLE_COMMANDS
+    return [c.strip() for c in env.split(",") if c.strip()]
+
+
+def is_cacheable(command: str, cacheable: list[str]) -> bool:
+    """Return True if command is an allowlisted read-only command."""
+    command = command.strip()
+    if _SIDE_EFFECT_CHARS.intersection(command):
+        return False
+    return any(command == c or command.startswith(c + " ") for c in cacheable)
+
+
+def output_text(output: str | bytes) -> str:
+    """Return command output as text for a plan step.
+
+    Bytes are decoded once; output that is not UTF-8 is kept losslessly as
+    base64 behind BASE64_OUTPUT_PREFIX.
+    """
+    if isinstance(output, str):
+        return output
+    try:
+        return output.decode("utf-8")
+    except UnicodeDecodeError:
+        return BASE64_OUTPUT_PREFIX + base64.b64encode(output).decode("ascii")
+
+
+def parse_step_selection(answer: str, numbers: list[int]) -> set[int] | None:
+    """Parse "all", "none" or a list like "1,3-5" into a set of step numbers.
+
+    An empty answer selects every number; returns None for invalid input.
+    """
+    answer = answer.strip().lower()
+    if answer in {"", "y", "yes", "all"}:
+        return set(numbers)
+    if answer in {"n", "no", "none"}:
+        return set()
+    selected = set()
+    for part in answer.replace(" ", "").split(","):
+        first, _, last = part.partition("-")
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        selected.update(range(int(first), int(last or first) + 1))
+    return selected if selected <= set(numbers) else None
+
+
+def _run_batch(batch: List[PlanStep], run_command_fn) -> list:
+    """Run the commands of a batch, concurrently if run_command_fn is async."""
+    if inspect.iscoroutinefunction(run_command_fn):
+        async def run_all():
+            return await asyncio.gather(*(run_command_fn(s.command) for s in batch))
+
+        return asyncio.run(run_all())
+    return [run_command_fn(s.command) for s in batch]
 
 
 def execute_plan(
     steps: List[PlanStep],
-    plan_path: str,
+    plan_path: str | os.PathLike,
     knowledge: dict,
-    knowledge_path: str,
+    knowledge_path: str | os.PathLike,
     run_command_fn,
     update_knowledge_fn,
     confirm_each_step: bool = False,
     input_fn=input,
+    flush_every: int = 1,
+    confirm_mode: str | None = None,
 ) -> List[PlanStep]:
-    """Run each pending step sequentially."""
-    for step in steps:
-        if step.status != "pending":
-            continue
-        print(f"Step: {step.description}")
-        print(f"Command: {step.command}")
-        if confirm_each_step:
-            ans = input_fn("Run this command? (press enter for yes, 'n' to skip): ").strip().lower()
-            if ans == "n":
-                print("Step declined. Pausing plan.")
-                step.status = "pending"
-                save_plan(plan_path, steps)
+    """Run each pending step in order.
+
+    A step marked independent depends on none of the steps since the last
+    step without the flag, so a run of them is one batch with the step
+    before it; with an async run_command_fn the batch runs concurrently.
+    A step whose predecessor in the plan is not pending (declined earlier or
+    left unselected) starts a new batch.
+    Each batch's results are appended to the plan's journal in one write; the
+    plan file itself is rewritten once when execution stops.
+
+    Results are passed to update_knowledge_fn once flush_every of them have
+    accumulated, and any remainder when execution stops; flush_every=0 holds
+    them all until then.
+
+    A repeated read-only command (see is_cacheable) reuses its earlier output
+    as long as no other command has run since.
+
+    run_command_fn may return its output as str or bytes (see output_text).
+
+    confirm_mode is "per_step" (ask before each step), "batch" (list the
+    pending steps and ask once which to run) or "none"; it defaults to
+    "per_step" when confirm_each_step is set.
+    """
+    if confirm_mode is None:
+        confirm_mode = "per_step" if confirm_each_step else "none"
+    plan_path = os.fspath(plan_path)
+    knowledge_path = os.fspath(knowledge_path)
+    updates = []
+
+    def flush_updates() -> None:
+        for command, output, success in updates:
+            update_knowledge_fn(knowledge_path, knowledge, command, output, success)
+        updates.clear()
+
+    cacheable = _cacheable_commands()
+    seen = {}  # read-only command -> result, since the last other command ran
+    pending = [i for i, s in enumerate(steps) if s.status == "pending"]
+    if confirm_mode == "batch" and pending:
+        print("\n".join(f"{i + 1}. {steps[i].command}" for i in pending))
+        numbers = [i + 1 for i in pending]
+        while True:
+            answer = input_fn("Run which steps? (enter for all, 'n' for none, or e.g. 1,3-5): ")
+            selected = parse_step_selection(answer, numbers)
+            if selected is not None:
                 break
-        output, success = run_command_fn(step.command)
-        step.output = output
-        step.success = success
-        step.status = "done" if success else "failed"
-        update_knowledge_fn(knowledge_path, knowledge, step.command, output, success)
-        save_plan(plan_path, steps)
-        if not success:
+            print("Invalid selection.")
+        if not selected:
+            print("No steps selected. Pausing plan.")
+        pending = [i for i in pending if i + 1 in selected]
+    start = 0
+    while start < len(pending):
+        end = start + 1
+        while (
+            end < len(pending)
+            and pending[end] == pending[end - 1] + 1
+            and steps[pending[end]].independent
+        ):
+            end += 1
+        batch = pending[start:end]
+        start = end
+        approved = []
+        declined = False
+        for index in batch:
+            step = steps[index]
+            # One write per step; stdout is only flushed when it is a terminal
+            print(f"Step: {step.description}\nCommand: {step.command}")
+            if confirm_mode == "per_step":
+                ans = input_fn("Run this command? (press enter for yes, 'n' to skip): ").strip().lower()
+                if ans == "n":
+                    declined = True
+                    break
+            approved.append(index)
+        approved_steps = [steps[i] for i in approved]
+        reused = {i: seen[steps[i].command] for i in approved if steps[i].command in seen}
+        to_run = [i for i in approved if i not in reused]
+        ran = _run_batch([steps[i] for i in to_run], run_command_fn) if to_run else []
+        results = {**reused, **dict(zip(to_run, ran))}
+        if all(is_cacheable(steps[i].command, cacheable) for i in to_run):
+            seen.update((steps[i].command, r) for i, r in zip(to_run, ran) if r[1])
+        else:
+            seen.clear()
+        for index in approved:
+            step = steps[index]
+            output, success = results[index]
+            output = output_text(output)
+            if index in reused:
+                print(f"(same output as the earlier run of {step.command})")
+            step.output = output
+            step.success = success
+            step.status = "done" if success else "failed"
+            updates.append((step.command, output, success))
+        journal = None
+        if approved:
+            journal = _io_pool.submit(
+                _append_step_updates, plan_path, [(i, steps[i]) for i in approved]
+            )
+        try:
+            if flush_every and len(updates) >= flush_every:
+                flush_updates()
+        finally:
+            if journal is not None:
+                journal.result()
+        if declined:
+            print("Step declined. Pausing plan.")
+            break
+        if not all(step.success for step in approved_steps):
             print("Step failed. Stopping execution.")
             break
+    saved = _io_pool.submit(save_plan, plan_path, steps)
+    flush_updates()
+    saved.result()
     return steps
 
 
-def interactive_edit_plan(path: str) -> None:
+def _input_prefilled(label: str, current: str) -> str:
+    """Ask for a new value, keeping the current one if the answer is empty."""
+    if readline is None:
+        return input(f"{label} [{current}]: ").strip() or current
+    # Pre-fill the line with the current value so it can be edited in place
+    readline.set_startup_hook(lambda: readline.insert_text(current))
+    try:
+        return input(f"{label}: ").strip() or current
+    finally:
+        readline.set_startup_hook()
+
+
+def interactive_edit_plan(path: str | os.PathLike) -> None:
     steps = load_plan(path)
     if not steps:
         print("No plan found.")
         return
+    # Rendered lines by step index; an edit re-renders only its own line
+    lines = [f"{idx}. {s.description}: {s.command} [{s.status}]" for idx, s in enumerate(steps, 1)]
+    changed = True
     while True:
-        for idx, s in enumerate(steps, 1):
-            print(f"{idx}. {s.description}: {s.command} [{s.status}]")
+        # Only reprint the plan when an edit changed it, in a single write
+        if changed:
+            print("\n".join(lines))
+            changed = False
         choice = input("Edit step number (enter to finish): ").strip()
         if not choice:
             break
@@ -101,10 +609,10 @@ def interactive_edit_plan(path: str) -> None:
         except (ValueError, IndexError):
             print("Invalid step.")
             continue
-        desc = input(f"Description [{step.description}]: ").strip()
-        cmd = input(f"Command [{step.command}]: ").strip()
-        if desc:
-            step.description = desc
-        if cmd:
-            step.command = cmd
+        before = (step.description, step.command)
+        step.description = _input_prefilled("Description", step.description)
+        step.command = _input_prefilled("Command", step.command)
+        if (step.description, step.command) != before:
+            lines[i] = f"{i + 1}. {step.description}: {step.command} [{step.status}]"
+            changed = True
     save_plan(path, steps)
@@ -0,0 +1,96 @@
+import asyncio
+import itertools
+import os
+import sys
+import time
+import types
+
+import pytest
+
+# Run against the checkout, with a stand-in openai so nothing needs the SDK
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+class FakeOpenAIClient:
+    """Stands in for openai.OpenAI; create_fn answers chat.completions.create."""
+
+    def __init__(self, create_fn=None):
+        self.chat = types.SimpleNamespace(
+            completions=types.SimpleNamespace(create=create_fn)
+        )
+
+
+def fake_stream(content: str, size: int = 7):
+    """Yield content as streamed chat completion chunks of size characters."""
+    for i in range(0, len(content), size):
+        delta = types.SimpleNamespace(content=content[i : i + size])
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+
+sys.modules.setdefault("openai", types.SimpleNamespace(OpenAI=lambda **_: FakeOpenAIClient()))
+
+# Imported once here so every test module shares the same loaded modules
+import cortana  # noqa: E402
+import planner  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: spawns real shell processes (deselect with -m 'not slow')")
+
+
+@pytest.fixture(scope="session")
+def session_tmp(tmp_path_factory):
+    """One base directory for the run; tests take unique names beneath it."""
+    return tmp_path_factory.mktemp("cortana_tests")
+
+
+_cache_ids = itertools.count()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, session_tmp):
+    # Only named here: the rules and plan caches create it when they first write
+    path = session_tmp / f"cache-{next(_cache_ids)}"
+    monkeypatch.setenv("CORTANA_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def knowledge_state():
+    """Finish queued knowledge writes and forget unflushed knowledge bases."""
+    yield
+    cortana.wait_for_knowledge_writes()
+    cortana._PENDING_SNAPSHOTS.clear()
+    cortana._logged_commands.clear()
+
+
+@pytest.fixture(scope="session")
+def kb_template():
+    """A knowledge base as load_knowledge leaves it, with fresh system details."""
+    return {"system": {"os": "FakeOS", "system_ts": time.time()}, "commands": [], "stats": {}, "paths": {}}
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop for every async test, instead of asyncio.run per call."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_backend(request, monkeypatch):
+    """Run the test once with orjson (when installed) and once with stdlib json."""
+    if request.param == "orjson" and cortana.orjson is None:
+        pytest.skip("orjson not installed")
+    if request.param == "json":
+        monkeypatch.setattr(cortana, "orjson", None)
+        monkeypatch.setattr(planner, "orjson", None)
+    return request.param
+
+
+@pytest.fixture
+def in_tmp(monkeypatch, tmp_path):
+    """Run commands in tmp_path; cortana.CURRENT_DIR is restored afterwards."""
+    monkeypatch.setattr(cortana, "CURRENT_DIR", str(tmp_path))
+    return tmp_path
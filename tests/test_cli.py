@@ -1,6 +1,5 @@
 import builtins
 import io
-import os
 import sys
 import types
 import tempfile
@@ -9,21 +8,8 @@ from unittest.mock import patch
 
 import pytest
 
-# Add project root to path
-sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-
-# Fake openai module so cli can import
-class FakeOpenAIClient:
-    def __init__(self, create_fn=None):
-        self.chat = types.SimpleNamespace(
-            completions=types.SimpleNamespace(create=create_fn)
-        )
-
-
-fake_openai = types.SimpleNamespace(OpenAI=lambda **_: FakeOpenAIClient())
-sys.modules["openai"] = fake_openai
-
 import cortana as cli
+from conftest import FakeOpenAIClient, fake_stream
 
 
 class FakeResponse:
@@ -57,13 +43,20 @@ def run_cli_inputs(monkeypatch, inputs, replies, knowledge_file):
 
     def fake_create(**_kwargs):
         calls.append([m.copy() for m in _kwargs.get("messages", [])])
+        assert _kwargs.get("response_format") == {"type": "json_object"}
+        if _kwargs.get("stream"):
+            return fake_stream(next(replies_iter))
         return FakeResponse(next(replies_iter))
 
     monkeypatch.setattr(builtins, "input", fake_input)
+    # main() gathers system details on a background thread; keep it off the
+    # real system so it finishes at once and cannot outlive the test
+    monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "FakeOS"})
+    monkeypatch.setattr(cli, "list_packages", lambda: [])
     monkeypatch.setenv("OPENAI_API_KEY", "test")
     monkeypatch.setenv("CORTANA_KNOWLEDGE_FILE", knowledge_file)
     monkeypatch.setattr(
-        cli.openai,
+        sys.modules["openai"],
         "OpenAI",
         lambda **_: FakeOpenAIClient(fake_create),
         raising=False,
@@ -254,6 +247,7 @@ def test_command_execution_records_success(monkeypatch, tmp_path):
         extra_inputs=[""],
     )
 
+    cli.flush_knowledge()
     with open(knowledge) as f:
         data = json.load(f)
 
@@ -400,3 +394,129 @@ def test_new_conversation_command(monkeypatch, tmp_path):
     assert "Starting a new conversation." in out
     assert len(calls) == 2
     assert len(calls[1]) == 2  # system + user only
+
+
+def test_stream_explanation_echoes_tokens(capsys):
+    raw = '{"explanation": "Line one\\nsaid \\"hi\\" \\u00e9 \\ud83d\\ude00", "command": "ls"}'
+    text, shown = cli.stream_explanation(fake_stream(raw, size=3))
+    assert text == raw
+    assert shown == 'Line one\nsaid "hi" \u00e9 \U0001f600'
+    shown.encode("utf-8")  # no lone surrogates
+    assert capsys.readouterr().out == "AI: " + shown
+
+
+def test_trim_history_keeps_system_and_latest(monkeypatch):
+    monkeypatch.setattr(cli, "count_tokens", len)
+    messages = [{"role": "system", "content": "s" * 50}] + [
+        {"role": "user", "content": str(i) * 10} for i in range(5)
+    ]
+    cli.trim_history(messages, max_tokens=25)
+    assert [m["content"] for m in messages] == ["s" * 50, "3" * 10, "4" * 10]
+    cli.trim_history(messages, max_tokens=1)
+    assert [m["content"] for m in messages] == ["s" * 50, "4" * 10]
+
+
+def test_review_plan_prints_steps_as_they_stream(monkeypatch, tmp_path, capsys):
+    from planner import PlanStep, load_plan
+
+    printed_before = []
+
+    def fake_iter_plan(task):
+        yield PlanStep("list", "ls")
+        printed_before.append(capsys.readouterr().out)
+        yield PlanStep("disk", "df -h", independent=True)
+
+    answers = iter(["?", ""])
+    monkeypatch.setattr(cli, "iter_plan", fake_iter_plan)
+    monkeypatch.setattr(builtins, "input", lambda _="": next(answers))
+    plan_file = tmp_path / "plan.json"
+    steps = cli.review_plan("look around", str(plan_file))
+    assert printed_before == ["Proposed plan:\n1. list: ls\n"]
+    assert capsys.readouterr().out == "2. disk: df -h\nProposed plan:\n1. list: ls\n2. disk: df -h\n"
+    assert load_plan(str(plan_file)) == steps
+
+
+def test_review_plan_forgets_rejected_plans(monkeypatch, tmp_path):
+    from planner import PlanStep
+
+    forgotten = []
+    answers = iter(["u", "use sudo", "n"])
+    monkeypatch.setattr(cli, "iter_plan", lambda task: iter([PlanStep("list", "ls")]))
+    monkeypatch.setattr(cli, "forget_plan", forgotten.append)
+    monkeypatch.setattr(builtins, "input", lambda _="": next(answers))
+    assert cli.review_plan("look around", str(tmp_path / "plan.json")) is None
+    assert forgotten == ["look around", "look around. use sudo"]
+
+
+def test_edit_plan_skips_api_setup(monkeypatch):
+    edited = []
+    monkeypatch.setattr(sys, "argv", ["cortana", "--edit-plan"])
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(cli, "interactive_edit_plan", edited.append)
+    monkeypatch.setattr(cli, "load_knowledge", None)
+    cli.main()
+    assert edited == ["task_plan.json"]
+
+
+def test_summarize_knowledge_lists_first_paths():
+    paths = {f"/srv/{i}": "file" for i in range(10_000)}
+    summary = cli.summarize_knowledge({"system": {"os": "FakeOS"}, "paths": paths})
+    assert summary == "OS: FakeOS. Known paths: /srv/0, /srv/1, /srv/2, /srv/3, /srv/4"
+    assert cli.summarize_knowledge({"system": {"os": "FakeOS"}}) == "OS: FakeOS."
+
+
+def test_build_system_prompt_is_cached():
+    knowledge = {"system": {"os": "FakeOS"}, "paths": {}}
+    history = [{"command": f"cmd{i}", "success": i % 2 == 0} for i in range(7)]
+    prompt = cli.build_system_prompt(history, knowledge)
+    assert "OS: FakeOS." in prompt
+    assert prompt.endswith("Recent command history: cmd2 (ok); cmd3 (failed); cmd4 (ok); cmd5 (failed); cmd6 (ok)")
+    assert cli.build_system_prompt(list(history), dict(knowledge)) is prompt
+    knowledge["system"]["os"] = "OtherOS"
+    assert "OS: OtherOS." in cli.build_system_prompt(history, knowledge)
+
+
+@pytest.mark.parametrize(
+    "raw,expected",
+    [
+        ('{"explanation": "list", "command": "ls"}', ("list", "ls")),
+        ('{"explanation": "say "hi"", "command": "echo"}', ('say "hi"', "echo")),
+        ('{"explanation": "no command"}', None),
+        ('{"explanation": "bad", "command": 3}', None),
+        ('["explanation", "command"]', None),
+    ],
+)
+def test_parse_cortana_response(raw, expected):
+    data = cli.parse_cortana_response(raw)
+    if expected is None:
+        assert data is None
+    else:
+        assert (data.explanation, data.command) == expected
+
+
+def test_run_script_answers_prompts_concurrently(tmp_path, capsys):
+    script = tmp_path / "prompts.txt"
+    script.write_text("list files\n\nshow disk\nbroken\n")
+    in_flight = 0
+    peak = 0
+
+    async def fake_create(**kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await cli.asyncio.sleep(0.01)
+        in_flight -= 1
+        assert kwargs["response_format"] == {"type": "json_object"}
+        prompt = kwargs["messages"][-1]["content"]
+        if prompt == "broken":
+            return FakeResponse("not-json")
+        return FakeResponse(json.dumps({"explanation": prompt, "command": "ls"}))
+
+    output = tmp_path / "out.jsonl"
+    cli.run_script(FakeOpenAIClient(fake_create), str(script), str(output), {"system": {}})
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["prompt"] for r in results] == ["list files", "show disk", "broken"]
+    assert results[0] == {"prompt": "list files", "explanation": "list files", "command": "ls"}
+    assert results[2]["raw"] == "not-json"
+    assert peak == 3
+    assert "Wrote 3 results" in capsys.readouterr().out
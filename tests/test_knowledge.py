@@ -1,56 +1,185 @@
+import io
 import os
 import json
+import logging
 import sys
-import types
 import tempfile
-import asyncio
+import threading
+import time
+import shlex
+import sqlite3
 
 import pytest
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import cortana as cli
 
-# Ensure cli imports without real openai dependency
-fake_openai = types.SimpleNamespace()
-sys.modules.setdefault("openai", fake_openai)
 
-import cortana as cli
+@pytest.fixture
+def kb_path(monkeypatch, tmp_path, kb_template):
+    """Write the template knowledge base so load_knowledge only has to read it."""
+    monkeypatch.setattr(cli, "package_db_mtime", lambda: None)
+    path = tmp_path / "kb.json"
+    path.write_text(json.dumps(kb_template))
+    return path
 
 
 def test_load_knowledge_initializes_file(monkeypatch, tmp_path):
     path = tmp_path / "kb.json"
     monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "FakeOS"})
-    data = cli.load_knowledge(str(path))
+    data = cli.load_knowledge(path)
     assert path.exists()
     assert data["system"]["os"] == "FakeOS"
-    assert data["commands"] == []
+    assert data["commands"] == {}
     with open(path) as f:
         saved = json.load(f)
-    assert saved == data
+    assert saved == {**data, "commands": []}
 
 
 def test_load_knowledge_handles_invalid_json(monkeypatch, tmp_path):
     path = tmp_path / "kb.json"
     path.write_text("{broken")
     monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "FakeOS"})
-    data = cli.load_knowledge(str(path))
+    data = cli.load_knowledge(path)
     assert data["system"]["os"] == "FakeOS"
-    assert data["commands"] == []
+    assert data["commands"] == {}
 
 
-def test_update_knowledge_appends_command(tmp_path, monkeypatch):
-    path = tmp_path / "kb.json"
-    monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "FakeOS"})
-    data = cli.load_knowledge(str(path))
-    cli.update_knowledge(str(path), data, "echo hi", "hi\n", True)
-    with open(path) as f:
-        saved = json.load(f)
-    assert saved["commands"][-1] == {
+def test_update_knowledge_appends_command(kb_path):
+    path = kb_path
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "echo hi", "hi\n", True)
+    # update_knowledge mutates data in place; persistence is covered by the log tests
+    assert data["commands"]["echo hi"] == {
         "command": "echo hi",
-        "output": "hi\n",
+        "outputs": ["hi\n"],
         "success": True,
     }
 
 
+def test_update_knowledge_appends_to_log(kb_path, tmp_path):
+    path = kb_path
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "echo hi", "hi\n", True)
+    cli.wait_for_knowledge_writes()
+    with open(path) as f:
+        assert json.load(f)["commands"] == []
+    log = tmp_path / "kb.json.log.jsonl"
+    assert json.loads(log.read_text()) == {"command": "echo hi", "output": "hi\n", "success": True}
+    with open(log, "a") as f:
+        f.write('{"command": "torn')
+    reloaded = cli.load_knowledge(path)
+    assert reloaded["commands"] == data["commands"]
+    assert reloaded["stats"]["echo hi"] == {"success": 1, "failure": 0}
+    assert not log.exists()
+
+
+def test_update_knowledge_records_paths_in_background(monkeypatch, kb_path, tmp_path):
+    path = kb_path
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "notes.txt").write_text("hi")
+    monkeypatch.setattr(cli, "CURRENT_DIR", str(tmp_path))
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "ls -la sub sub/notes.txt missing", "", True)
+    monkeypatch.setattr(cli, "CURRENT_DIR", "/")
+    cli.flush_knowledge()
+    expected = {str(tmp_path / "sub"): "directory", str(tmp_path / "sub" / "notes.txt"): "file"}
+    assert data["paths"] == expected
+    with open(path) as f:
+        assert json.load(f)["paths"] == expected
+
+
+def test_logged_paths_survive_a_crash(monkeypatch, kb_path, tmp_path):
+    (tmp_path / "notes.txt").write_text("hi")
+    monkeypatch.setattr(cli, "CURRENT_DIR", str(tmp_path))
+    data = cli.load_knowledge(kb_path)
+    cli.update_knowledge(kb_path, data, "cat notes.txt", "hi", True)
+    cli.wait_for_knowledge_writes()
+    cli._PENDING_SNAPSHOTS.clear()  # crash: no flush at exit
+    assert cli.load_knowledge(kb_path)["paths"] == {str(tmp_path / "notes.txt"): "file"}
+
+
+def test_update_knowledge_snapshots_periodically(monkeypatch, kb_path, tmp_path):
+    path = kb_path
+    monkeypatch.setattr(cli, "KNOWLEDGE_SNAPSHOT_EVERY", 3)
+    data = cli.load_knowledge(path)
+    for i in range(4):
+        cli.update_knowledge(path, data, f"echo {i}", f"{i}\n", True)
+        if i == 2:
+            cli.wait_for_knowledge_writes()
+            with open(path) as f:
+                assert len(json.load(f)["commands"]) == 3
+            assert not (tmp_path / "kb.json.log.jsonl").exists()
+    cli.wait_for_knowledge_writes()
+    log = (tmp_path / "kb.json.log.jsonl").read_text().splitlines()
+    assert [json.loads(line)["command"] for line in log] == ["echo 3"]
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_snapshot_excludes_commands_recorded_after_it(monkeypatch, kb_path):
+    monkeypatch.setattr(cli, "KNOWLEDGE_SNAPSHOT_EVERY", 2)
+    data = cli.load_knowledge(kb_path)
+    release = threading.Event()
+    cli._KNOWLEDGE_WRITER.submit(release.wait)  # hold the writer
+    for command in ("c1", "c2", "c3"):
+        cli.update_knowledge(kb_path, data, command, "", True)
+    release.set()
+    cli.wait_for_knowledge_writes()
+    cli._PENDING_SNAPSHOTS.clear()  # crash: no flush at exit
+    reloaded = cli.load_knowledge(kb_path)
+    assert reloaded["stats"] == {c: {"success": 1, "failure": 0} for c in ("c1", "c2", "c3")}
+
+
+def test_knowledge_json_backends(kb_path, json_backend):
+    path = kb_path
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "echo café", "café\n", True)
+    cli.flush_knowledge()
+    raw = path.read_bytes()
+    assert "café".encode() in raw
+    assert cli.load_knowledge(path)["commands"] == data["commands"]
+    with pytest.raises(ValueError):
+        cli._json_loads(b'{"torn')
+    assert cli._json_dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode()
+
+
+def test_gather_system_info_runs_probes_concurrently(monkeypatch):
+    barrier = threading.Barrier(4, timeout=5)
+
+    def probe(value):
+        def run():
+            barrier.wait()
+            return value
+        return run
+
+    monkeypatch.setattr(cli, "list_packages", probe(["bash"]))
+    monkeypatch.setattr(cli, "list_running_services", probe(["init"]))
+    monkeypatch.setattr(cli, "disk_free_mb", probe(10))
+    monkeypatch.setattr(cli, "memory_total_mb", probe(20))
+    info = cli.gather_system_info()
+    assert info["packages"] == ["bash"]
+    assert info["running_services"] == ["init"]
+    assert (info["disk_free_mb"], info["memory_total_mb"]) == (10, 20)
+    assert info["os"]
+
+
+def test_memory_total_mb_reads_meminfo(monkeypatch):
+    real_open = os.open
+    meminfo = os.pipe()
+    os.write(meminfo[1], b"MemTotal:        2097152 kB\nMemFree:  1 kB\n")
+    os.close(meminfo[1])
+    monkeypatch.setattr(
+        cli.os, "open", lambda path, *a: meminfo[0] if path == "/proc/meminfo" else real_open(path, *a)
+    )
+    assert cli.memory_total_mb() == 2048
+
+    def missing(*args):
+        raise FileNotFoundError(args[0])
+
+    monkeypatch.setattr(cli.os, "open", missing)
+    assert cli.memory_total_mb() == 0
+
+
+@pytest.mark.slow
 def test_run_command_success_and_failure():
     out, success = cli.run_command("echo test")
     assert success
@@ -59,62 +188,420 @@ def test_run_command_success_and_failure():
     assert not success2
 
 
-def test_run_command_async_success_and_failure():
-    out, success = asyncio.run(cli.run_command_async("echo async"))
+@pytest.mark.slow
+def test_run_command_async_success_and_failure(event_loop):
+    async def run_both():
+        return await cli.run_command_async("echo async"), await cli.run_command_async("false")
+
+    (out, success), (out2, success2) = event_loop.run_until_complete(run_both())
     assert success
     assert out.strip() == "async"
-    out2, success2 = asyncio.run(cli.run_command_async("false"))
     assert not success2
 
 
-def test_check_command_rules():
-    rules = {"blocked": [], "confirm": ["apt install"]}
-    assert cli.check_command_rules("rm file", {"blocked": ["rm"], "confirm": []}) == "block"
-    assert cli.check_command_rules("sudo apt install htop", rules) == "confirm"
-    assert cli.check_command_rules("rm -rf /", rules) == "danger"
-    assert cli.check_command_rules("nano file.txt", rules) == "block"
-    assert cli.check_command_rules("vim file.txt", rules) == "block"
+CONFIRM_RULES = {"blocked": [], "confirm": ["apt install"]}
+
+
+@pytest.mark.parametrize(
+    "command, rules, expected",
+    [
+        ("rm file", {"blocked": ["rm"], "confirm": []}, "block"),
+        ("sudo apt install htop", CONFIRM_RULES, "confirm"),
+        ("rm -rf /", CONFIRM_RULES, "danger"),
+        ("nano file.txt", CONFIRM_RULES, "block"),
+        ("vim file.txt", CONFIRM_RULES, "block"),
+    ],
+)
+def test_check_command_rules(command, rules, expected):
+    assert cli.check_command_rules(command, rules) == expected
+
 
+def test_check_command_rules_cache_hit():
+    cli._cached_automaton.cache_clear()
+    rules = {"blocked": ["shutdown"], "confirm": ["apt install", "pip install"]}
+    for _ in range(1000):
+        assert cli.check_command_rules("sudo apt install htop", rules) == "confirm"
+    info = cli._cached_automaton.cache_info()
+    assert (info.misses, info.hits) == (2, 1998)
 
-def test_persistent_cd(monkeypatch, tmp_path):
-    cli.CURRENT_DIR = str(tmp_path)
+
+def test_persistent_cd(in_tmp):
     out, success = cli.run_command("pwd")
     assert success
-    assert out.strip() == str(tmp_path)
-    cli.run_command("mkdir sub")
+    assert out.strip() == str(in_tmp)
+    (in_tmp / "sub").mkdir()
     cli.run_command("cd sub")
     out2, success2 = cli.run_command("pwd")
     assert success2
-    assert out2.strip() == str(tmp_path / "sub")
+    assert out2.strip() == str(in_tmp / "sub")
 
 
-def test_edit_file(monkeypatch, tmp_path):
-    cli.CURRENT_DIR = str(tmp_path)
+def test_edit_file(in_tmp):
     out, success = cli.run_command("edit file.txt hello")
     assert success
-    assert (tmp_path / "file.txt").read_text() == "hello"
+    assert (in_tmp / "file.txt").read_text() == "hello"
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "command",
+    ["pwd", "whoami", "cat a.txt b.txt", "head a.txt", "head -n 2 a.txt", "tail -3 a.txt"],
+)
+def test_builtins_match_shell(monkeypatch, in_tmp, command):
+    (in_tmp / "a.txt").write_text("".join(f"line {i}\n" for i in range(15)))
+    (in_tmp / "b.txt").write_text("no newline")
+    monkeypatch.setenv("CORTANA_NO_BUILTINS", "1")
+    expected = cli.run_command(command)
+    monkeypatch.delenv("CORTANA_NO_BUILTINS")
+
+    def no_shell(*args, **kwargs):
+        raise AssertionError("builtin should not spawn a shell")
+
+    with monkeypatch.context() as m:
+        m.setattr(cli.subprocess, "Popen", no_shell)
+        assert cli.run_command(command) == expected
+
+
+def test_whoami_builtin_without_passwd_entry(monkeypatch):
+    import pwd
+
+    def no_entry(uid):
+        raise KeyError(f"getpwuid(): uid not found: {uid}")
+
+    monkeypatch.setattr(pwd, "getpwuid", no_entry)
+    # No builtin result, so run_command hands whoami to the shell
+    assert cli.run_builtin("whoami") is None
+
+
+@pytest.mark.slow
+def test_builtins_fall_back_to_shell(in_tmp, event_loop):
+    (in_tmp / "a.txt").write_text("x\ny\n")
+    assert cli.run_command("cat a.txt | wc -l")[0].strip() == "2"
+    assert cli.run_command("cat -n a.txt")[0].split() == ["1", "x", "2", "y"]
+    out, success = cli.run_command("cat missing.txt")
+    assert not success and "missing.txt" in out
+    out, success = event_loop.run_until_complete(cli.run_command_async("head -1 a.txt"))
+    assert (out, success) == ("x\n", True)
+
+
+def test_cat_builtin_streams_chunks(monkeypatch, in_tmp):
+    (in_tmp / "big.txt").write_bytes(b"x" * 10)
+    monkeypatch.setattr(cli, "READ_CHUNK_SIZE", 4)
+    chunks = cli._builtin_cat(("big.txt",))
+    assert list(chunks) == [b"xxxx", b"xxxx", b"xx"]
+    assert cli.run_builtin("cat big.txt") == ("x" * 10, True)
+
+
+def test_builtins_leave_devices_to_the_shell(in_tmp):
+    assert cli._builtin_cat(("/dev/zero",)) is None
+    assert cli._builtin_head(("-n", "1", "/dev/zero")) is None
+    assert cli._builtin_tail(("/dev/zero",)) is None
+
+
+@pytest.mark.parametrize(
+    "command",
+    ["ls -la  /tmp", "echo 'a b' c", 'grep "x y" file', "echo a\\ b", "\tuptime\n"],
+)
+def test_fast_split_matches_shlex(command):
+    assert cli._fast_split(command) == tuple(shlex.split(command))
 
 
 def test_load_knowledge_includes_stats(monkeypatch, tmp_path):
     path = tmp_path / "kb.json"
     monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "Fake"})
-    data = cli.load_knowledge(str(path))
+    data = cli.load_knowledge(path)
     assert "stats" in data
 
 
-def test_update_knowledge_stats(monkeypatch, tmp_path):
+def test_update_knowledge_stats(kb_path):
+    path = kb_path
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "cmd", "", True)
+    cli.update_knowledge(path, data, "cmd", "", False)
+    assert data["stats"]["cmd"] == {"success": 1, "failure": 1}
+
+
+@pytest.mark.slow
+def test_run_command_failure_message(capsys, caplog):
+    with caplog.at_level(logging.WARNING, logger="cortana"):
+        cli.run_command("false")
+    assert "'false' exited with code 1" in caplog.text
+    assert "Command exited with code" in capsys.readouterr().out
+
+
+def test_read_rpm_sqlite(monkeypatch, tmp_path):
+    db = tmp_path / "packages.db"
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE installed (pkg TEXT)")
+    conn.executemany("INSERT INTO installed VALUES (?)", [("bash",), ("nginx",)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(
+        cli,
+        "RPM_SQLITE_SOURCES",
+        [(str(tmp_path / "missing.db"), "SELECT 1"), (str(db), "SELECT pkg FROM installed")],
+    )
+    assert cli.read_rpm_sqlite() == ["bash", "nginx"]
+
+
+def test_read_rpm_sqlite_without_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "RPM_SQLITE_SOURCES", [(str(tmp_path / "none.db"), "SELECT 1")])
+    assert cli.read_rpm_sqlite() is None
+
+
+def test_read_dpkg_status(monkeypatch, tmp_path):
+    status = tmp_path / "status"
+    status.write_bytes(
+        b"Package: bash\nStatus: install ok installed\nVersion: 5.2\n\n"
+        b"Package: oldpkg\nStatus: deinstall ok config-files\n\n"
+        b"Package: gone\nStatus: purge ok not-installed\n\n"
+        b"Package: nginx\nStatus: install ok installed\n"
+    )
+    monkeypatch.setattr(cli, "DPKG_STATUS_PATH", str(status))
+    assert cli.read_dpkg_status() == ["bash", "nginx"]
+
+
+def test_read_dpkg_status_missing(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "DPKG_STATUS_PATH", str(tmp_path / "missing"))
+    assert cli.read_dpkg_status() is None
+
+
+def test_load_knowledge_refreshes_packages_on_db_change(monkeypatch, tmp_path):
     path = tmp_path / "kb.json"
-    monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "Fake"})
-    data = cli.load_knowledge(str(path))
-    cli.update_knowledge(str(path), data, "cmd", "", True)
-    cli.update_knowledge(str(path), data, "cmd", "", False)
+    system = {"os": "FakeOS", "packages": ["old"], "_pkg_db_mtime": 1.0, "system_ts": time.time()}
+    path.write_text(json.dumps({"system": system}))
+    monkeypatch.setattr(cli, "package_db_mtime", lambda: 1.0)
+    monkeypatch.setattr(cli, "list_packages", lambda: ["new"])
+    assert cli.load_knowledge(path)["system"]["packages"] == ["old"]
+    monkeypatch.setattr(cli, "package_db_mtime", lambda: 2.0)
+    data = cli.load_knowledge(path)
+    assert data["system"]["packages"] == ["new"]
+    assert data["system"]["_pkg_db_mtime"] == 2.0
+
+
+def test_load_knowledge_skips_rewrite_when_unchanged(monkeypatch, tmp_path):
+    path = tmp_path / "kb.json"
+    monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "FakeOS"})
+    monkeypatch.setattr(cli, "package_db_mtime", lambda: None)
+    data = cli.load_knowledge(path)
+    assert path.exists()
+
+    def fail(*_):
+        raise AssertionError("unchanged knowledge should not be rewritten")
+
+    with monkeypatch.context() as m:
+        m.setattr(cli, "_write_knowledge_snapshot", fail)
+        assert cli.load_knowledge(path) == data
+    cli.update_knowledge(path, data, "echo hi", "hi\n", True)
+    cli.wait_for_knowledge_writes()
+    assert cli.load_knowledge(path)["commands"] == data["commands"]
+    assert not (tmp_path / "kb.json.log.jsonl").exists()
+
+
+def test_load_knowledge_regathers_stale_system_info(monkeypatch, tmp_path):
+    path = tmp_path / "kb.json"
+    system = {"os": "OldOS", "_pkg_db_mtime": 1.0, "system_ts": time.time() - 120}
+    path.write_text(json.dumps({"system": system}))
+    monkeypatch.setattr(cli, "package_db_mtime", lambda: 1.0)
+    monkeypatch.setattr(cli, "gather_system_info", lambda: {"os": "NewOS", "_pkg_db_mtime": 1.0})
+    monkeypatch.setenv("CORTANA_SYSTEM_TTL", "3600")
+    assert cli.load_knowledge(path)["system"]["os"] == "OldOS"
+    assert cli.load_knowledge(path, refresh_system=True)["system"]["os"] == "NewOS"
+    path.write_text(json.dumps({"system": system}))
+    monkeypatch.setenv("CORTANA_SYSTEM_TTL", "60")
+    data = cli.load_knowledge(path)
+    assert data["system"]["os"] == "NewOS"
+    assert time.time() - data["system"]["system_ts"] < 60
+
+
+def test_list_running_services_reads_proc(monkeypatch, tmp_path):
+    for pid, name in [("10", "sshd"), ("2", "kthreadd"), ("self", "python")]:
+        (tmp_path / pid).mkdir()
+        (tmp_path / pid / "comm").write_text(name + "\n")
+    (tmp_path / "99").mkdir()  # exited before its comm could be read
+    monkeypatch.setattr(cli, "PROC_PATH", str(tmp_path))
+    assert cli.list_running_services() == ["kthreadd", "sshd"]
+    monkeypatch.setattr(cli, "PROC_PATH", str(tmp_path / "missing"))
+    monkeypatch.setattr(cli, "command_lines", lambda args, skip=0: ["from-ps"])
+    assert cli.list_running_services() == ["from-ps"]
+
+
+@pytest.mark.slow
+def test_command_lines():
+    assert cli.command_lines(["printf", "head\\na\\n\\nb\\n"], skip=1) == ["a", "b"]
+    assert cli.command_lines(["false"]) == []
+
+
+def test_check_command_rules_with_loaded_rules(monkeypatch, tmp_path):
+    safety = tmp_path / "safety.yaml"
+    safety.write_text("blocked:\n  - shutdown\nconfirm:\n  - apt install\n  - systemctl restart\n")
+    monkeypatch.setenv("CORTANA_SAFETY_RULES", str(safety))
+    monkeypatch.setenv("CORTANA_PREFERENCES", str(tmp_path / "none.yaml"))
+    monkeypatch.setenv("CORTANA_WHITELIST", str(tmp_path / "none"))
+    rules = cli.load_rules()
+    assert rules["auto_set"] == frozenset(rules["auto"])
+    assert cli.check_command_rules("sudo shutdown -h now", rules) == "block"
+    assert cli.check_command_rules("sudo systemctl restart nginx", rules) == "confirm"
+    assert cli.check_command_rules("ls -la", rules) == "auto"
+    assert cli.check_command_rules("echo hi", rules) is None
+
+
+def test_load_rules_uses_cache_until_files_change(monkeypatch, tmp_path, cache_dir):
+    safety = tmp_path / "safety.yaml"
+    safety.write_text("blocked:\n  - shutdown\n")
+    monkeypatch.setenv("CORTANA_SAFETY_RULES", str(safety))
+    monkeypatch.setenv("CORTANA_PREFERENCES", str(tmp_path / "none.yaml"))
+    monkeypatch.setenv("CORTANA_WHITELIST", str(tmp_path / "none"))
+    assert cli.load_rules()["blocked"] == ["shutdown"]
+    assert (cache_dir / "rules.json").exists()
+
+    def fail(*_):
+        raise AssertionError("rule files should not be re-read")
+
+    with monkeypatch.context() as m:
+        m.setattr(cli, "_read_rule_files", fail)
+        m.setattr(cli, "_rules_cache", {})
+        assert cli.load_rules()["blocked"] == ["shutdown"]
+
+    safety.write_text("blocked:\n  - reboot\n  - halt\n")
+    assert cli.load_rules()["blocked"] == ["reboot", "halt"]
+
+
+def test_load_rules_memoizes_in_process(monkeypatch, tmp_path):
+    safety = tmp_path / "safety.yaml"
+    safety.write_text("blocked:\n  - shutdown\n")
+    monkeypatch.setenv("CORTANA_SAFETY_RULES", str(safety))
+    monkeypatch.setenv("CORTANA_PREFERENCES", str(tmp_path / "none.yaml"))
+    monkeypatch.setenv("CORTANA_WHITELIST", str(tmp_path / "none"))
+    first = cli.load_rules()
+    first["blocked"].append("reboot")
+
+    monkeypatch.setattr(cli, "_json_loads", None)
+    monkeypatch.setattr(cli, "_read_rule_files", None)
+    assert cli.load_rules()["blocked"] == ["shutdown"]
+
+
+@pytest.mark.parametrize("backend", ["ahocorasick", "regex", "loop"])
+def test_dangerous_patterns_matchers(monkeypatch, backend):
+    if backend == "ahocorasick" and cli.ahocorasick is None:
+        pytest.skip("pyahocorasick not installed")
+    if backend != "ahocorasick":
+        monkeypatch.setattr(cli, "ahocorasick", None)
+    matcher = cli.build_automaton(cli.DANGEROUS_PATTERNS) if backend != "loop" else None
+    monkeypatch.setattr(cli, "DANGER_AUTOMATON", matcher)
+    rules = {"has_user_rules": False, "auto": []}
+    assert cli.check_command_rules("sudo dd if=/dev/zero of=/dev/sda", rules) == "danger"
+    assert cli.check_command_rules("mkfs.ext4 /dev/sdb1", rules) == "danger"
+    assert cli.check_command_rules("rm -rf build", rules) is None
+
+
+@pytest.mark.slow
+def test_run_command_streams_partial_lines(capsys):
+    out, success = cli.run_command("printf 'progress 50%%\\r'; printf 'caf\\303\\251'")
+    assert success
+    assert out == "progress 50%\rcafé"
+    assert capsys.readouterr().out == out
+
+
+@pytest.mark.slow
+def test_run_command_async_streams_partial_lines(capsys, event_loop):
+    out, success = event_loop.run_until_complete(
+        cli.run_command_async("printf 'progress 50%%\\r'; printf 'caf\\303\\251'")
+    )
+    assert success
+    assert out == "progress 50%\rcafé"
+    assert capsys.readouterr().out == out
+
+
+def test_check_command_rules_without_user_rules(monkeypatch, tmp_path):
+    monkeypatch.setenv("CORTANA_SAFETY_RULES", str(tmp_path / "none.yaml"))
+    monkeypatch.setenv("CORTANA_PREFERENCES", str(tmp_path / "none.yaml"))
+    monkeypatch.setenv("CORTANA_WHITELIST", str(tmp_path / "none"))
+    rules = cli.load_rules()
+    assert rules["has_user_rules"] is False
+    assert cli.check_command_rules("rm -rf /", rules) == "danger"
+    assert cli.check_command_rules("vim notes", rules) == "block"
+    assert cli.check_command_rules("ls", rules) == "auto"
+
+
+def test_load_knowledge_gathers_system_in_background(monkeypatch, tmp_path):
+    path = tmp_path / "kb.json"
+    release = threading.Event()
+
+    def slow_gather():
+        release.wait(5)
+        return {"os": "FakeOS"}
+
+    monkeypatch.setattr(cli, "gather_system_info", slow_gather)
+    data = cli.load_knowledge(path, background=True)
+    assert data["system"] == {"pending": True}
+    release.set()
+    for _ in range(500):
+        if not data["system"].get("pending"):
+            break
+        time.sleep(0.01)
+    assert data["system"]["os"] == "FakeOS"
+    assert "system_ts" in data["system"]
+    cli.flush_knowledge()
     with open(path) as f:
-        saved = json.load(f)
-    assert saved["stats"]["cmd"]["success"] == 1
-    assert saved["stats"]["cmd"]["failure"] == 1
+        assert json.load(f)["system"] == data["system"]
+
+
+def test_update_knowledge_keeps_one_entry_per_command(kb_path):
+    path = kb_path
+    data = cli.load_knowledge(path)
+    cli.update_knowledge(path, data, "systemctl status nginx", "inactive", False)
+    cli.update_knowledge(path, data, "uptime", "up 1 day", True)
+    cli.update_knowledge(path, data, "systemctl status nginx", "active", True)
+    assert list(data["commands"]) == ["uptime", "systemctl status nginx"]
+    assert data["commands"]["systemctl status nginx"] == {
+        "command": "systemctl status nginx", "outputs": ["inactive", "active"], "success": True,
+    }
+    assert data["stats"]["systemctl status nginx"] == {"success": 1, "failure": 1}
+    assert cli.load_knowledge(path)["commands"] == data["commands"]
+    cli.flush_knowledge()
+    stored = json.loads(path.read_text())["commands"]
+    assert [c["command"] for c in stored] == ["uptime", "systemctl status nginx"]
+
+
+def test_load_knowledge_migrates_command_list(tmp_path, kb_template):
+    path = tmp_path / "kb.json"
+    commands = [
+        {"command": "ls", "output": "a\n", "success": True},
+        {"command": "uptime", "output": "up", "success": True},
+        {"command": "ls", "output": "b\n", "success": False},
+    ]
+    path.write_text(json.dumps({**kb_template, "commands": commands}))
+    data = cli.load_knowledge(path)
+    assert data["commands"] == {
+        "uptime": {"command": "uptime", "outputs": ["up"], "success": True},
+        "ls": {"command": "ls", "outputs": ["a\n", "b\n"], "success": False},
+    }
+
+
+def test_list_packages_falls_back_to_python_distributions(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "DPKG_STATUS_PATH", str(tmp_path / "missing"))
+    monkeypatch.setattr(cli, "RPM_SQLITE_SOURCES", [])
+    monkeypatch.setattr(cli.shutil, "which", lambda _name: None)
+    packages = cli.list_packages()
+    assert "pytest" in packages
+    assert len(packages) == len(set(packages))
+
+
+def test_output_echo_without_binary_buffer(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    echo = cli.output_echo()
+    for chunk in [b"caf", b"\xc3", b"\xa9\n", b""]:
+        echo(chunk)
+    assert out.getvalue() == "café\n"
+
 
+def test_read_rule_files_without_libyaml(monkeypatch, tmp_path):
+    import yaml
 
-def test_run_command_failure_message(capsys):
-    cli.run_command("false")
-    captured = capsys.readouterr().out
-    assert "Command exited with code" in captured
+    monkeypatch.delattr(yaml, "CSafeLoader", raising=False)
+    safety = tmp_path / "safety.yaml"
+    safety.write_text("blocked:\n  - shutdown\nconfirm:\n  - apt install\n")
+    rules = cli._read_rule_files(str(safety), str(tmp_path / "none.yaml"), str(tmp_path / "none"))
+    assert rules == {"blocked": ["shutdown"], "confirm": ["apt install"], "auto": []}
@@ -1,103 +1,114 @@
+import asyncio
 import json
 import sys
+import time
 import types
-import os
 import builtins
+from pathlib import Path
 
 import pytest
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import cortana as cli
+import planner
+from conftest import FakeOpenAIClient, fake_stream
 
-class FakeOpenAIClient:
-    def __init__(self, create_fn=None):
-        self.chat = types.SimpleNamespace(
-            completions=types.SimpleNamespace(create=create_fn)
-        )
 
+# (description, command) pairs shared by several tests
+ABC_STEPS = (("one", "a"), ("two", "b"), ("three", "c"))
+CD_EDIT_STEPS = (
+    ("make", "mkdir sub"),
+    ("enter", "cd sub"),
+    ("write", "edit hi.txt hi"),
+    ("show", "cat hi.txt"),
+)
 
-fake_openai = types.SimpleNamespace(OpenAI=lambda **_: FakeOpenAIClient())
-sys.modules.setdefault("openai", fake_openai)
 
-import cortana as cli
-import planner
+def make_steps(pairs):
+    """Build fresh steps from (description, command) pairs; tests mutate them."""
+    return [planner.PlanStep(description=d, command=c) for d, c in pairs]
 
 
-def test_execute_plan_success(monkeypatch, tmp_path):
-    knowledge_path = tmp_path / "kb.json"
-    planner.save_plan(str(tmp_path / "plan.json"), [planner.PlanStep(description="step", command="echo hi")])
-    monkeypatch.setattr(cli, "run_command", lambda cmd: ("hi\n", True))
-    monkeypatch.setattr(cli, "update_knowledge", lambda *a, **k: None)
-    knowledge = {"system": {}, "commands": []}
-    steps = planner.load_plan(str(tmp_path / "plan.json"))
-    planner.execute_plan(steps, str(tmp_path / "plan.json"), knowledge, str(knowledge_path), cli.run_command, cli.update_knowledge)
-    assert steps[0].status == "done"
+@pytest.fixture
+def fake_shell(monkeypatch):
+    """Answer commands from a table instead of spawning a shell."""
+    responses = {"echo hi": ("hi\n", True), "false": ("", False)}
 
+    async def run_async(command):
+        return responses.get(command, ("", False))
 
-def test_execute_plan_failure(monkeypatch, tmp_path):
-    plan_file = tmp_path / "plan.json"
-    planner.save_plan(str(plan_file), [
-        planner.PlanStep(description="one", command="ok"),
-        planner.PlanStep(description="two", command="fail"),
-    ])
-    monkeypatch.setattr(cli, "run_command", lambda c: ("", c == "ok"))
+    monkeypatch.setattr(cli, "run_command", lambda command: responses.get(command, ("", False)))
+    monkeypatch.setattr(cli, "run_command_async", run_async)
+    return responses
+
+
+@pytest.mark.parametrize(
+    "outcomes, expected",
+    [
+        ([("hi\n", True)], ["done"]),
+        ([("", True), ("", False)], ["done", "failed"]),
+    ],
+)
+def test_execute_plan(monkeypatch, tmp_path, fake_shell, outcomes, expected):
+    steps = make_steps([(f"step {i}", f"c{i}") for i in range(len(outcomes))])
+    fake_shell.update({step.command: outcome for step, outcome in zip(steps, outcomes)})
     monkeypatch.setattr(cli, "update_knowledge", lambda *a, **k: None)
     knowledge = {"system": {}, "commands": []}
-    steps = planner.load_plan(str(plan_file))
-    planner.execute_plan(steps, str(plan_file), knowledge, str(tmp_path/"kb.json"), cli.run_command, cli.update_knowledge)
-    assert steps[0].status == "done"
-    assert steps[1].status == "failed"
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", knowledge, tmp_path / "kb.json", cli.run_command, cli.update_knowledge
+    )
+    assert [s.status for s in steps] == expected
+    assert [s.output for s in steps] == [output for output, _ in outcomes]
 
 
-def test_execute_plan_with_cd_and_edit(tmp_path, monkeypatch):
-    cli.CURRENT_DIR = str(tmp_path)
-    plan_file = tmp_path / "plan.json"
-    steps = [
-        planner.PlanStep(description="make", command="mkdir sub"),
-        planner.PlanStep(description="enter", command="cd sub"),
-        planner.PlanStep(description="write", command="edit hi.txt hi"),
-        planner.PlanStep(description="show", command="cat hi.txt"),
-    ]
-    planner.save_plan(str(plan_file), steps)
+def test_execute_plan_with_cd_and_edit(monkeypatch, in_tmp):
+    def no_shell(*args, **kwargs):
+        raise AssertionError("plan should run without spawning a shell")
+
+    def run(command):
+        # mkdir is the only step that is not a builtin; do it in-process
+        if command.startswith("mkdir "):
+            (Path(cli.CURRENT_DIR) / command.split()[1]).mkdir()
+            return "", True
+        return cli.run_command(command)
+
+    monkeypatch.setattr(cli.subprocess, "Popen", no_shell)
+    monkeypatch.delenv("CORTANA_NO_BUILTINS", raising=False)
+    steps = make_steps(CD_EDIT_STEPS)
     knowledge = {"system": {}, "commands": []}
     planner.execute_plan(
         steps,
-        str(plan_file),
+        in_tmp / "plan.json",
         knowledge,
-        str(tmp_path / "kb.json"),
-        cli.run_command,
+        in_tmp / "kb.json",
+        run,
         lambda *a, **k: None,
     )
-    assert (tmp_path / "sub" / "hi.txt").read_text() == "hi"
+    assert (in_tmp / "sub" / "hi.txt").read_text() == "hi"
     assert steps[3].output.strip() == "hi"
 
 
 def test_interactive_edit_plan(monkeypatch, tmp_path):
     path = tmp_path / "plan.json"
-    planner.save_plan(str(path), [planner.PlanStep(description="one", command="cmd")])
+    planner.save_plan(path, [planner.PlanStep(description="one", command="cmd")])
     inputs = iter(["1", "desc", "newcmd", ""])
     monkeypatch.setattr(builtins, "input", lambda _="": next(inputs))
-    planner.interactive_edit_plan(str(path))
-    steps = planner.load_plan(str(path))
+    planner.interactive_edit_plan(path)
+    steps = planner.load_plan(path)
     assert steps[0].description == "desc"
     assert steps[0].command == "newcmd"
 
 
-def test_execute_plan_with_confirmation(monkeypatch, tmp_path):
+def test_execute_plan_with_confirmation(monkeypatch, tmp_path, fake_shell):
     plan_file = tmp_path / "plan.json"
-    steps = [
-        planner.PlanStep(description="one", command="cmd1"),
-        planner.PlanStep(description="two", command="cmd2"),
-    ]
-    planner.save_plan(str(plan_file), steps)
+    steps = make_steps([("one", "cmd1"), ("two", "cmd2")])
     knowledge = {"system": {}, "commands": []}
-    monkeypatch.setattr(cli, "run_command", lambda c: ("", True))
     monkeypatch.setattr(cli, "update_knowledge", lambda *a, **k: None)
     inputs = iter(["n"])
     planner.execute_plan(
         steps,
-        str(plan_file),
+        plan_file,
         knowledge,
-        str(tmp_path / "kb.json"),
+        tmp_path / "kb.json",
         cli.run_command,
         cli.update_knowledge,
         confirm_each_step=True,
@@ -106,3 +117,427 @@ def test_execute_plan_with_confirmation(monkeypatch, tmp_path):
     assert steps[0].status == "pending"
     assert steps[1].status == "pending"
 
+
+def test_execute_plan_runs_independent_steps_concurrently(tmp_path):
+    plan_file = tmp_path / "plan.json"
+    steps = [
+        planner.PlanStep(description="one", command="a"),
+        planner.PlanStep(description="two", command="b", independent=True),
+        planner.PlanStep(description="three", command="c", independent=True),
+        planner.PlanStep(description="four", command="d"),
+    ]
+    running = 0
+    peak = 0
+    order = []
+
+    async def run(cmd):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        order.append(cmd)
+        return cmd, True
+
+    planner.execute_plan(
+        steps, plan_file, {}, tmp_path / "kb.json", run, lambda *a, **k: None
+    )
+    assert peak == 3
+    assert order[-1] == "d"
+    assert [s.output for s in steps] == ["a", "b", "c", "d"]
+    assert planner.load_plan(plan_file)[1].independent
+
+
+def test_execute_plan_waits_for_group_before_dependent_step(tmp_path):
+    steps = [
+        planner.PlanStep(description="make", command="mkdir out"),
+        planner.PlanStep(description="os", command="uname -s", independent=True),
+        planner.PlanStep(description="write", command="echo hi > out/f"),
+    ]
+    made = False
+
+    async def run(cmd):
+        nonlocal made
+        if cmd == "mkdir out":
+            await asyncio.sleep(0.02)
+            made = True
+        elif cmd == "echo hi > out/f" and not made:
+            return "out/f: Directory nonexistent", False
+        return "", True
+
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", {}, tmp_path / "kb.json", run, lambda *a, **k: None
+    )
+    assert [s.status for s in steps] == ["done"] * 3
+
+
+def test_execute_plan_does_not_batch_across_unselected_steps(monkeypatch, tmp_path):
+    steps = [
+        planner.PlanStep(description="make", command="mkdir out"),
+        planner.PlanStep(description="enter", command="cd out"),
+        planner.PlanStep(description="write", command="touch f", independent=True),
+    ]
+    batches = []
+
+    def run_batch(batch, run_command_fn):
+        batches.append([s.command for s in batch])
+        return [("", True)] * len(batch)
+
+    monkeypatch.setattr(planner, "_run_batch", run_batch)
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", {}, tmp_path / "kb.json",
+        None, lambda *a, **k: None,
+        confirm_mode="batch", input_fn=lambda _="": "1,3",
+    )
+    assert batches == [["mkdir out"], ["touch f"]]
+
+
+@pytest.mark.slow
+def test_execute_plan_parallel_independent(in_tmp):
+    steps = [
+        planner.PlanStep(description=f"wait {i}", command="sleep 0.2", independent=i > 0)
+        for i in range(3)
+    ]
+    start = time.perf_counter()
+    planner.execute_plan(
+        steps, in_tmp / "plan.json", {}, in_tmp / "kb.json",
+        cli.run_command_async, lambda *a, **k: None,
+    )
+    assert [s.status for s in steps] == ["done"] * 3
+    assert time.perf_counter() - start < 0.5
+
+
+def test_save_and_load_plan_json_backends(tmp_path, json_backend):
+    steps = [
+        planner.PlanStep(description="café", command="echo hi", status="done", output="hi\n", success=True),
+        planner.PlanStep(description="next", command="ls"),
+    ]
+    raw = planner._dump_steps(steps)
+    assert json.loads(raw.decode("utf-8"))[0]["description"] == "café"
+    assert planner._json_dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode()
+    assert planner._load_steps(planner._json_loads(raw)) == steps
+    path = tmp_path / "plan.json"
+    planner.save_plan(path, steps)
+    assert planner.load_plan(path) == steps
+
+
+def test_execute_plan_journals_step_results(tmp_path):
+    plan_file = tmp_path / "plan.json"
+    steps = make_steps(ABC_STEPS)
+    planner.save_plan(plan_file, steps)
+    base = plan_file.read_bytes()
+
+    def update(path, knowledge, command, output, success):
+        if command == "b":
+            raise KeyboardInterrupt  # stop after b is journaled, before the plan is saved again
+
+    with pytest.raises(KeyboardInterrupt):
+        planner.execute_plan(
+            steps, plan_file, {}, tmp_path / "kb.json", lambda c: (c + "\n", True), update
+        )
+    assert plan_file.read_bytes() == base
+    with open(tmp_path / "plan.json.log", "a") as f:
+        f.write('{"i": 2, "sta')
+    loaded = planner.load_plan(plan_file)
+    assert [(s.status, s.output) for s in loaded] == [("done", "a\n"), ("done", "b\n"), ("pending", "")]
+
+    planner.execute_plan(
+        loaded, plan_file, {}, tmp_path / "kb.json", lambda c: (c, True), lambda *a: None
+    )
+    assert not (tmp_path / "plan.json.log").exists()
+    assert [s.status for s in planner.load_plan(plan_file)] == ["done", "done", "done"]
+
+
+def test_generate_plan_reads_independent_steps(monkeypatch):
+    reply = json.dumps({"steps": [
+        {"description": "disk", "command": "df -h"},
+        {"description": "memory", "command": "free -m", "independent": True},
+    ]})
+
+    def create(**kwargs):
+        assert "independent" in kwargs["messages"][0]["content"]
+        return fake_stream(reply)
+
+    clients = []
+
+    def make_client(**_):
+        clients.append(FakeOpenAIClient(create))
+        return clients[-1]
+
+    monkeypatch.setattr(planner, "_client", None)
+    monkeypatch.setitem(sys.modules, "openai", types.SimpleNamespace(OpenAI=make_client))
+    steps = planner.generate_plan("check resources")
+    assert [(s.command, s.independent) for s in steps] == [("df -h", False), ("free -m", True)]
+    planner.generate_plan("check again")
+    assert len(clients) == 1
+
+
+def test_generate_plan_keeps_system_prompt_static(monkeypatch):
+    systems = []
+
+    def create(**kwargs):
+        systems.append(kwargs["messages"][0])
+        return fake_stream(json.dumps({"steps": []}))
+
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(create))
+    planner.generate_plan("first task")
+    planner.generate_plan("second task")
+    assert systems[0] == systems[1] == {"role": "system", "content": planner.PLAN_PROMPT}
+
+
+def test_generate_plan_caches_by_task(monkeypatch, cache_dir, json_backend):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["messages"][-1]["content"])
+        reply = json.dumps({"steps": [{"description": "list", "command": f"ls # {len(calls)}"}]})
+        return fake_stream(reply)
+
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(create))
+    first = planner.generate_plan("list files")
+    first[0].status = "done"
+    assert planner.generate_plan(" list files ") == [planner.PlanStep("list", "ls # 1")]
+    assert calls == ["list files"]
+    assert (cache_dir / "plans.json").exists()
+
+    monkeypatch.setattr(planner, "PLAN_CACHE_TTL", 0)
+    assert planner.generate_plan("list files")[0].command == "ls # 2"
+
+
+def test_generate_plan_ignores_invalid_cache_entries(monkeypatch, cache_dir):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["messages"][-1]["content"])
+        return fake_stream(json.dumps({"steps": [{"description": "list", "command": "ls"}]}))
+
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(create))
+    key = planner._plan_cache_key("list files")
+    cache_dir.mkdir()
+    cache_file = cache_dir / "plans.json"
+    # Fields a reply may not set are dropped rather than passed to PlanStep
+    edited = {"description": "old", "command": "ls -l", "status": "done", "extra": 1}
+    cache_file.write_text(json.dumps({key: {"ts": time.time(), "steps": [edited]}}))
+    assert planner.generate_plan("list files") == [planner.PlanStep("old", "ls -l")]
+    assert calls == []
+    # An entry that fails validation is a cache miss
+    cache_file.write_text(json.dumps({key: {"ts": time.time(), "steps": [{"description": "old"}]}}))
+    assert planner.generate_plan("list files") == [planner.PlanStep("list", "ls")]
+    assert planner.generate_plan("list files") == [planner.PlanStep("list", "ls")]
+    assert calls == ["list files"]
+
+    planner.forget_plan("list files")
+    planner.generate_plan("list files")
+    assert len(calls) == 2
+
+
+def test_iter_plan_yields_steps_while_streaming(monkeypatch):
+    reply = json.dumps({"steps": [
+        {"description": "make [dir]", "command": "mkdir -p 'a, b'"},
+        {"description": "list", "command": "ls", "independent": True},
+    ]}, indent=2)
+    received = []
+
+    def create(**kwargs):
+        assert kwargs["stream"] is True
+        assert kwargs["response_format"]["json_schema"]["strict"] is True
+        for chunk in fake_stream(reply, size=5):
+            received.append(chunk)
+            yield chunk
+
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(create))
+    plan = planner.iter_plan("make a dir")
+    first = next(plan)
+    assert first == planner.PlanStep("make [dir]", "mkdir -p 'a, b'")
+    assert len(received) < len(reply) / 5
+    assert list(plan) == [planner.PlanStep("list", "ls", independent=True)]
+
+
+def test_iter_plan_rejects_invalid_reply(monkeypatch):
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(lambda **_: fake_stream("no plan")))
+    with pytest.raises(ValueError):
+        planner.generate_plan("anything")
+
+
+def test_execute_plan_writes_each_step_header_once(monkeypatch, tmp_path):
+    writes = []
+    fake_stdout = types.SimpleNamespace(write=writes.append, flush=lambda: None)
+    monkeypatch.setattr(sys, "stdout", fake_stdout)
+    steps = make_steps(ABC_STEPS[:2])
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", {}, tmp_path / "kb.json", lambda c: ("", True), lambda *a: None
+    )
+    assert [w for w in writes if w != "\n"] == ["Step: one\nCommand: a", "Step: two\nCommand: b"]
+
+
+def test_step_dict_covers_every_field():
+    import dataclasses
+
+    step = planner.PlanStep(description="d", command="c", independent=True)
+    assert planner._step_dict(step) == dataclasses.asdict(step)
+
+
+@pytest.mark.parametrize("with_readline", [True, False])
+def test_interactive_edit_plan_reprints_only_changes(monkeypatch, tmp_path, capsys, with_readline):
+    if not with_readline:
+        monkeypatch.setattr(planner, "readline", None)
+    elif planner.readline is None:
+        pytest.skip("readline not available")
+    path = tmp_path / "plan.json"
+    planner.save_plan(path, [planner.PlanStep(description="one", command="cmd")])
+    inputs = iter(["x", "1", "", "", "1", "", "ls", ""])
+    prompts = []
+
+    def fake_input(prompt=""):
+        prompts.append(prompt)
+        return next(inputs)
+
+    monkeypatch.setattr(builtins, "input", fake_input)
+    planner.interactive_edit_plan(path)
+    assert capsys.readouterr().out.count("1. one:") == 2
+    assert planner.load_plan(path)[0].command == "ls"
+    assert ("Command [cmd]: " in prompts) is not with_readline
+
+
+def test_save_plan_keeps_old_plan_when_interrupted(monkeypatch, tmp_path):
+    path = tmp_path / "plan.json"
+    planner.save_plan(path, [planner.PlanStep(description="one", command="a")])
+
+    def broken_dump(steps):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(planner, "_dump_steps", broken_dump)
+    with pytest.raises(KeyboardInterrupt):
+        planner.save_plan(path, [planner.PlanStep(description="two", command="b")])
+    assert planner.load_plan(path) == [planner.PlanStep(description="one", command="a")]
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        '{"plan": []}',
+        '{"steps": ["ls"]}',
+        '{"steps": [{"description": "list"}]}',
+        '{"steps": [{"description": "list", "command": "ls", "independent": "yes"}]}',
+    ],
+)
+def test_generate_plan_rejects_malformed_steps(monkeypatch, reply):
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(lambda **_: fake_stream(reply)))
+    with pytest.raises(ValueError):
+        planner.generate_plan("anything")
+
+
+def test_generate_plan_ignores_fields_the_model_should_not_set(monkeypatch):
+    reply = '{"steps": [{"description": "list", "command": "ls", "status": "done", "extra": 1}]}'
+    monkeypatch.setattr(planner, "_client", FakeOpenAIClient(lambda **_: fake_stream(reply)))
+    assert planner.generate_plan("list") == [planner.PlanStep(description="list", command="ls")]
+
+
+def test_execute_plan_flushes_knowledge_updates_in_groups(tmp_path):
+    steps = [planner.PlanStep(description=str(i), command=f"c{i}") for i in range(5)]
+    flushed = []
+
+    def update(path, knowledge, command, output, success):
+        flushed.append((command, [s.status for s in steps].count("done")))
+
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", {}, tmp_path / "kb.json",
+        lambda c: ("", True), update, flush_every=2,
+    )
+    assert flushed == [("c0", 2), ("c1", 2), ("c2", 4), ("c3", 4), ("c4", 5)]
+
+
+def test_execute_plan_writes_knowledge_once_when_flushing_at_end(monkeypatch, tmp_path):
+    kb = tmp_path / "kb.json"
+    writes = []
+    write_snapshot = cli._write_knowledge_snapshot
+
+    def counting_write(path, snapshot):
+        writes.append(path)
+        write_snapshot(path, snapshot)
+
+    monkeypatch.setattr(cli, "_write_knowledge_snapshot", counting_write)
+    steps = [planner.PlanStep(description=f"step {i}", command=f"c{i}") for i in range(4)]
+    ran = []
+
+    def update(*args):
+        assert len(ran) == 4
+        cli.update_knowledge(*args)
+
+    knowledge = {"system": {}, "commands": [], "stats": {}, "paths": {}}
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", knowledge, kb,
+        lambda c: (ran.append(c) or "", True), update, flush_every=0,
+    )
+    cli.flush_knowledge()
+    assert writes.count(str(kb)) == 1
+    assert [c["command"] for c in json.loads(kb.read_text())["commands"]] == ["c0", "c1", "c2", "c3"]
+
+
+@pytest.mark.parametrize("contents", [b"", b"[{\"description\": ", b"\x00\x01"])
+def test_load_plan_unreadable_file(tmp_path, contents, json_backend):
+    path = tmp_path / "plan.json"
+    path.write_bytes(contents)
+    assert planner.load_plan(path) == []
+
+
+def test_execute_plan_reuses_repeated_read_only_output(monkeypatch, tmp_path):
+    commands = ["ls", "pwd", "ls", "touch x", "ls", "ls > out", "ls > out", "ls"]
+    steps = [planner.PlanStep(description=c, command=c) for c in commands]
+    ran = []
+
+    def run(command):
+        ran.append(command)
+        return f"{command} #{len(ran)}", True
+
+    monkeypatch.delenv("CORTANA_CACHEABLE", raising=False)
+    planner.execute_plan(steps, tmp_path / "plan.json", {}, tmp_path / "kb.json", run, lambda *a: None)
+    assert ran == ["ls", "pwd", "touch x", "ls", "ls > out", "ls > out", "ls"]
+    assert steps[2].output == "ls #1"
+    assert all(s.status == "done" for s in steps)
+
+
+def test_cacheable_commands_from_environment(monkeypatch):
+    monkeypatch.setenv("CORTANA_CACHEABLE", "kubectl get, ls")
+    cacheable = planner._cacheable_commands()
+    assert planner.is_cacheable("kubectl get pods", cacheable)
+    assert not planner.is_cacheable("pwd", cacheable)
+    assert not planner.is_cacheable("ls; rm x", cacheable)
+
+
+@pytest.mark.parametrize(
+    "answer,expected",
+    [("", {1, 2, 4}), ("all", {1, 2, 4}), ("n", set()), ("1, 4", {1, 4}), ("1-2", {1, 2}), ("3", None), ("x", None)],
+)
+def test_parse_step_selection(answer, expected):
+    assert planner.parse_step_selection(answer, [1, 2, 4]) == expected
+
+
+def test_execute_plan_batch_confirmation(tmp_path, capsys):
+    steps = [planner.PlanStep(description=str(i), command=f"c{i}") for i in range(1, 5)]
+    steps[0].status = "done"
+    answers = iter(["9", "2,4"])
+    ran = []
+    planner.execute_plan(
+        steps, tmp_path / "plan.json", {}, tmp_path / "kb.json",
+        lambda c: ran.append(c) or ("", True), lambda *a: None,
+        confirm_mode="batch", input_fn=lambda _="": next(answers),
+    )
+    assert ran == ["c2", "c4"]
+    assert [s.status for s in steps] == ["done", "done", "pending", "done"]
+    out = capsys.readouterr().out
+    assert out.startswith("2. c2\n3. c3\n4. c4\nInvalid selection.\n")
+
+
+def test_execute_plan_accepts_byte_output(tmp_path):
+    plan_file = tmp_path / "plan.json"
+    steps = make_steps([("text", "a"), ("binary", "b")])
+    outputs = {"a": "café\n".encode(), "b": b"\xff\xfe"}
+    recorded = []
+    planner.execute_plan(
+        steps, plan_file, {}, tmp_path / "kb.json",
+        lambda c: (outputs[c], True), lambda path, kb, cmd, out, ok: recorded.append(out),
+    )
+    assert recorded == ["café\n", "base64://4="]
+    assert [s.output for s in planner.load_plan(plan_file)] == recorded